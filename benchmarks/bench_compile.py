@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import statistics
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pbat.core import read_compile_write
+from pbat import parsescript, core
+
+DEF = """def step{i}{deps}
+    download(https://example.com/pkg{i}.zip, :cache)
+    unzip(pkg{i}.zip, :o=C:\\pkg{i}, :t=C:\\pkg{i}\\bin)
+    add_path(C:\\pkg{i}\\bin)
+    echo step {i}
+
+"""
+
+def make_defs(n):
+    lines = ["github-workflow on\n\n"]
+    for i in range(n):
+        deps = " depends on step{}".format(i - 1) if i > 0 and i % 3 != 0 else ""
+        lines.append(DEF.format(i=i, deps=deps))
+    # chains of 3 defs, main depends on last def of each chain
+    ends = [i for i in range(n) if i % 3 == 2 or i == n - 1]
+    lines.append("def main depends on {}\n    echo done\n".format(" ".join("step{}".format(i) for i in ends)))
+    return {"main.pbat": "".join(lines)}
+
+def make_include_deep(depth):
+    files = {"main.pbat": "include(inc0)\ndef main depends on {}\n    echo done\n".format(" ".join("def{}".format(i) for i in range(depth)))}
+    for i in range(depth):
+        body = DEF.format(i=i, deps="").replace("def step{}".format(i), "def def{}".format(i))
+        if i + 1 < depth:
+            body = "include(inc{})\n".format(i + 1) + body
+        files["inc{}.pbat".format(i)] = body
+    return files
+
+def make_include_wide(width):
+    main = ["include(inc{})\n".format(i) for i in range(width)]
+    main.append("def main depends on shared_a shared_b {}\n    echo done\n".format(" ".join("def{}".format(i) for i in range(width))))
+    files = {"main.pbat": "".join(main)}
+    files["shared_a.pbat"] = "def shared_a\n    echo a\n"
+    files["shared_b.pbat"] = "include(shared_a)\ndef shared_b\n    echo b\n"
+    for i in range(width):
+        body = DEF.format(i=i, deps="").replace("def step{}".format(i), "def def{}".format(i))
+        files["inc{}.pbat".format(i)] = "include(shared_a)\ninclude(shared_b)\n" + body
+    return files
+
+def make_macro_heavy(n, per_def):
+    lines = ["github-workflow on\n\n"]
+    macros = [
+        "download(https://example.com/{i}/{j}.zip, :cache)",
+        "unzip({j}.zip, :o=out{i}, :t=out{i}\\{j})",
+        "git_clone(https://example.com/{i}/{j}.git, :ref=v1.{j}, :pull)",
+        "zip(app{i}.zip, build\\{j}.exe, build\\{j}.dll)",
+        "patch(..\\{j}.patch, :p1, :N)",
+        "add_path(C:\\tools{i}\\{j})",
+    ]
+    for i in range(n):
+        lines.append("def m{}\n".format(i))
+        for j in range(per_def):
+            lines.append("    " + macros[j % len(macros)].format(i=i, j=j) + "\n")
+        lines.append("\n")
+    lines.append("def main depends on {}\n    echo done\n".format(" ".join("m{}".format(i) for i in range(n))))
+    return {"main.pbat": "".join(lines)}
+
+def make_foreach(n, items):
+    values = ", ".join("v{}".format(k) for k in range(items))
+    other = ", ".join("w{}".format(k) for k in range(items))
+    lines = []
+    for i in range(n):
+        lines.append("def f{}\n    foreach(echo $1 $2, [{}], [{}])\n\n".format(i, values, other))
+    lines.append("def main depends on {}\n    echo done\n".format(" ".join("f{}".format(i) for i in range(n))))
+    return {"main.pbat": "".join(lines)}
+
+CORPORA = {
+    "defs_1k": lambda: make_defs(1000),
+    "defs_10k": lambda: make_defs(10000),
+    "include_deep": lambda: make_include_deep(300),
+    "include_wide": lambda: make_include_wide(500),
+    "macro_heavy": lambda: make_macro_heavy(200, 50),
+    "foreach_large": lambda: make_foreach(20, 2000),
+}
+
+def write_corpus(dirname, files):
+    for name, text in files.items():
+        with open(os.path.join(dirname, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+    return sum(text.count('\n') for text in files.values())
+
+def compile_once(dirname):
+    # file and macro caches are process-wide, drop them so every run reads and parses sources
+    parsescript.file_cache.clear()
+    core.macro_cache.clear()
+    src = os.path.join(dirname, "main.pbat")
+    read_compile_write(src, os.path.join(dirname, "main.bat"), os.path.join(dirname, ".github", "workflows", "main.yml"), verbose=False)
+
+def run(name, repeat):
+    dirname = tempfile.mkdtemp(prefix='pbat_bench_')
+    try:
+        lines = write_corpus(dirname, CORPORA[name]())
+        compile_once(dirname)
+        times = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            compile_once(dirname)
+            times.append(time.perf_counter() - t)
+        # separate run, tracemalloc slows compilation down
+        tracemalloc.start()
+        compile_once(dirname)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(dirname)
+    seconds = statistics.median(times)
+    return {"lines": lines, "seconds": seconds, "lines_per_second": lines / seconds, "peak_mb": peak / 1024 / 1024}
+
+def compare(results, baseline, threshold):
+    """
+    Returns names of corpora that are slower or use more memory than baseline by more than threshold
+    """
+    failed = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        time_ratio = result["seconds"] / base["seconds"]
+        mem_ratio = result["peak_mb"] / base["peak_mb"] if base["peak_mb"] > 0 else 1.0
+        status = "ok"
+        if time_ratio > 1 + threshold or mem_ratio > 1 + threshold:
+            status = "REGRESSION"
+            failed.append(name)
+        print("{:<16} time {:6.2f}x  memory {:6.2f}x  {}".format(name, time_ratio, mem_ratio, status))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end read_compile_write throughput and peak memory on generated corpora')
+    parser.add_argument('names', nargs='*', help='corpora to run: {}'.format(", ".join(CORPORA)))
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='PATH', help='write results as json baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare with json baseline, exit code 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown or memory growth, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    names = args.names if len(args.names) > 0 else list(CORPORA)
+    for name in names:
+        if name not in CORPORA:
+            parser.error("unknown corpus {}".format(name))
+
+    results = dict()
+    print("{:<16} {:>8} {:>10} {:>12} {:>10}".format("corpus", "lines", "seconds", "lines/s", "peak MB"))
+    for name in names:
+        result = run(name, args.repeat)
+        results[name] = result
+        print("{:<16} {:>8} {:>10.3f} {:>12.0f} {:>10.1f}".format(name, result["lines"], result["seconds"], result["lines_per_second"], result["peak_mb"]))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({"python": platform.python_version(), "results": results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        failed = compare(results, baseline, args.threshold)
+        if len(failed) > 0:
+            print("regressed: {}".format(", ".join(failed)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+import argparse
+from lark import Lark
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pbat.parsemacro import parse_macro, GRAMMAR
+
+LINES = [
+    'download(http://example.com/foo.zip, :cache)\n',
+    'unzip(compiler.zip, :o=C:\\compiler, :t=C:\\compiler\\cl.exe)\n',
+    'git_clone(https://example.com/lib.git, :ref=v1.2.3, :pull)\n',
+    'zip(app.zip, build\\app.exe, C:\\example\\bin\\example.dll)\n',
+    'qt = github_matrix([5.15.2, 6.5.0, 6.6.1])\n',
+    'foreach(echo $1 $2, [a, b, c], [d, e, f])\n',
+    'github_cache(C:\\compiler, :k=compiler)\n',
+    'patch(..\\patch.patch, :p1, :N)\n',
+]
+
+def bench(fn, lines, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            fn(line)
+    return len(lines) * repeat / (time.perf_counter() - t)
+
+def main():
+    parser = argparse.ArgumentParser(description='macro expression parser throughput')
+    parser.add_argument('-n', '--repeat', type=int, default=250)
+    args = parser.parse_args()
+
+    earley = Lark(GRAMMAR)
+    before = bench(earley.parse, LINES, args.repeat)
+    after = bench(parse_macro, LINES, args.repeat)
+    print("earley (parse only): {:10.0f} lines/s".format(before))
+    print("lalr + transformer:  {:10.0f} lines/s".format(after))
+    print("speedup: {:.1f}x".format(after / before))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def measure(cmd, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='pbat --version cold start time')
+    parser.add_argument('-n', '--repeat', type=int, default=20)
+    parser.add_argument('--target', type=float, default=50, help='budget in ms, exit code 1 if exceeded')
+    args = parser.parse_args()
+
+    python = measure([sys.executable, '-c', 'pass'], args.repeat)
+    version = measure([sys.executable, '-c', 'from pbat.compile import main; main()', '--version'], args.repeat)
+    print("python -c pass:    {:6.1f} ms".format(python * 1000))
+    print("pbat --version:    {:6.1f} ms (target {:.0f} ms)".format(version * 1000, args.target))
+    if version * 1000 > args.target:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,8 @@ class Opts:
     unzip_test: bool = True
     zip_test: bool = True
     github: bool = False
-    github_workflow = False
+    github_workflow: bool = False
+    github_jobs: bool = False
     github_image: str = WINDOWS_LATEST
     github_on: int = ON_PUSH
     msys2_msystem: str = None
@@ -27,9 +28,16 @@ class Opts:
     use_patch: bool = False
     need_curl_var: bool = False
     need_patch_var: bool = False
+    need_fetch: bool = False
     env_policy: bool = False
     use_patch_var: bool = False
     workflow_name: str = 'main'
+    parallel_downloads: int = None
+    checkpoint: bool = False
+    parallel: str = None
+    local_matrix: str = None
+    timing: bool = False
+    prefetch: list = field(default_factory=list)
 
 def copy_opts(opts: Opts) -> Opts:
     res = Opts()
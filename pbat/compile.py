@@ -1,38 +1,51 @@
 import os
-import argparse
-import glob
+import sys
 
 try:
-    from .core import read_compile_write, get_dst_bat, get_dst_workflow
+    from . import __version__
 except ImportError:
-    from core import read_compile_write, get_dst_bat, get_dst_workflow
+    from __init__ import __version__
 
-def find_pbats(path):
-    paths = []
-    for n in os.listdir(path):
-        if os.path.splitext(n)[1] != '.pbat':
-            continue
-        p = os.path.join(path, n)
-        paths.append(p)
-    return paths
+def compile_file(src):
+    try:
+        from .core import read_compile_write, get_dst_bat, get_dst_workflow
+        from .profiling import profiler
+    except ImportError:
+        from core import read_compile_write, get_dst_bat, get_dst_workflow
+        from profiling import profiler
+    import io
+    import contextlib
+    dst_bat = get_dst_bat(src)
+    dst_workflow = get_dst_workflow(src)
+    # warnings are captured and printed by main process along with result
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), profiler.file(src):
+            result = read_compile_write(src, dst_bat, dst_workflow, verbose=False)
+        return result, None, output.getvalue()
+    except Exception as e:
+        if os.environ.get('DEBUG_PBAT') == '1':
+            raise e
+        return None, str(e), output.getvalue()
 
 def replace_ext(path, ext):
     return os.path.splitext(path)[0] + ext
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", nargs='*', help='file, directory or glob')
-
-    args = parser.parse_args()
+def collect_paths(args_paths, recursive, verbose=True):
+    import glob
+    try:
+        from .discover import find_pbats, uniq_paths
+    except ImportError:
+        from discover import find_pbats, uniq_paths
     paths = []
-    for path in args.path:
+    for path in args_paths:
         if glob.has_magic(path):
-            for path_ in glob.glob(path):
+            for path_ in sorted(glob.glob(path, recursive=recursive)):
                 if os.path.splitext(path_)[1] == '.pbat':
                     paths.append(path_)
         else:
             if os.path.isdir(path):
-                paths += find_pbats(path)
+                paths += find_pbats(path, recursive)
             else:
                 if os.path.isfile(path):
                     path_ = replace_ext(path, '.pbat')
@@ -45,39 +58,169 @@ def main():
                         path_ = path + '.pbat'
                         if os.path.exists(path_):
                             paths.append(path_)
-                        else:
+                        elif verbose:
                             print("{} not found".format(path_))
-                    else:
+                    elif verbose:
                         print("{} not found".format(path))
 
-    if len(args.path) == 0:
-        paths = find_pbats('.')
+    if len(args_paths) == 0:
+        paths = find_pbats('.', recursive)
+
+    return uniq_paths(paths)
 
+def collect_dirs(args_paths, recursive):
     """
-    if len(paths) > 1 and args.output is not None:
-        print("--output argument requires one input")
-        exit(1)
+    Directories where new sources can appear, watched in -w mode
     """
+    try:
+        from .discover import find_dirs
+    except ImportError:
+        from discover import find_dirs
+    if len(args_paths) == 0:
+        return find_dirs('.', recursive)
+    dirs = []
+    for path in args_paths:
+        if os.path.isdir(path):
+            dirs += find_dirs(path, recursive)
+    return dirs
 
-    for src in paths:
-        if False:
-            pass
+def compile_paths(todo, jobs, manifest):
+    results = dict()
+
+    def on_result(src, result, error, output):
+        print_result(src, result, error, output)
+        if error is None:
+            manifest.update(src, result.includes, result.dst_paths)
         else:
-            dst_bat = get_dst_bat(src)
-            dst_workflow = get_dst_workflow(src)
-        if src == dst_bat:
+            manifest.remove(src)
+        results[src] = result
+
+    if jobs > 1 and len(todo) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map yields results in input order so output is the same for any number of jobs
+            for src, result in zip(todo, executor.map(compile_file, todo)):
+                on_result(src, *result)
+    else:
+        for src in todo:
+            on_result(src, *compile_file(src))
+
+    manifest.save()
+    return results
+
+def compile_sources(paths, force, jobs):
+    """
+    Compiles paths that changed since previous compilation (all paths if force), returns results and manifest
+    """
+    try:
+        from .manifest import Manifest
+    except ImportError:
+        from manifest import Manifest
+
+    # compile options are fixed, output depends only on sources and compiler version
+    manifest = Manifest(__version__)
+    if force:
+        todo = paths
+    else:
+        todo = [src for src in paths if not manifest.is_fresh(src)]
+
+    results = compile_paths(todo, jobs, manifest)
+    failed = sum(1 for result in results.values() if result is None)
+    changed = sum(len(result.changed) for result in results.values() if result is not None)
+    print("{} compiled, {} failed, {} skipped, {} outputs changed".format(len(todo) - failed, failed, len(paths) - len(todo), changed))
+    return results, manifest
+
+def main():
+    if sys.argv[1:] == ['--version']:
+        # fast path for version check, skips argparse import
+        print('pbat {}'.format(__version__))
+        return
+
+    if sys.argv[1:2] == ['serve']:
+        try:
+            from .serve import main as serve_main
+        except ImportError:
+            from serve import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", nargs='*', help='file, directory or glob')
+    parser.add_argument("-r", "--recursive", action='store_true', help='search directories recursively, respects .pbatignore')
+    parser.add_argument("-j", "--jobs", type=int, default=1, help='number of parallel processes, 0 for cpu count')
+    parser.add_argument("-f", "--force", action='store_true', help='compile files even if sources and includes are unchanged')
+    parser.add_argument("-w", "--watch", action='store_true', help='watch sources and includes and recompile on change')
+    parser.add_argument("-s", "--server", action='store_true', help='send paths to running `pbat serve` process, compile in this process if it is not running')
+    parser.add_argument("--socket", help='socket of `pbat serve` process')
+    parser.add_argument("--profile", action='store_true', help='print time and calls per compiler phase and counters (implies -j 1)')
+    parser.add_argument("--profile-json", metavar='PATH', help='write profile as json to PATH (implies --profile)')
+    parser.add_argument("--version", action='version', version='pbat {}'.format(__version__))
+
+    args = parser.parse_args()
+
+    paths = collect_paths(args.path, args.recursive)
+
+    if len(paths) == 0 and not args.watch:
+        return
+
+    for src in paths:
+        if src == replace_ext(src, '.bat'):
             print("src == dst", src)
             exit(1)
 
+    if args.server and not args.watch:
         try:
-            #print(src, dst_bat, dst_workflow)
-            read_compile_write(src, dst_bat, dst_workflow)
-        except Exception as e:
-            if os.environ.get('DEBUG_PBAT') == '1':
-                raise e
+            from .serve import request_compile
+        except ImportError:
+            from serve import request_compile
+        if request_compile(paths, args.force, args.socket):
+            return
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    profile = args.profile or args.profile_json is not None
+    if profile:
+        try:
+            from .profiling import profiler
+        except ImportError:
+            from profiling import profiler
+        # phases are measured in this process
+        profiler.enabled = True
+        jobs = 1
+
+    results, manifest = compile_sources(paths, args.force, jobs)
+
+    if profile:
+        if args.profile:
+            print(profiler.report())
+        if args.profile_json is not None:
+            profiler.save_json(args.profile_json)
+
+    if args.watch:
+        try:
+            from .watch import watch
+        except ImportError:
+            from watch import watch
+        includes = dict()
+        for src in paths:
+            if results.get(src) is not None:
+                includes[src] = results[src].includes
             else:
-                print(e)
+                includes[src] = manifest.includes(src)
+        discover = lambda: collect_paths(args.path, args.recursive, verbose=False)
+        recompile = lambda todo: compile_paths(todo, jobs, manifest)
+        dirs = lambda: collect_dirs(args.path, args.recursive)
+        watch(includes, discover, recompile, dirs)
+
+def print_result(src, result, error, output):
+    print(output, end='')
+    if error is not None:
+        print(error)
+    else:
+        dst_paths = [path if path in result.changed else path + " (unchanged)" for path in result.dst_paths]
+        print("{} -> \n {}".format(src, "\n ".join(dst_paths)))
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
@@ -3,20 +3,29 @@ import os
 import re
 import random
 import textwrap
-import yaml
+import copy
 from collections import defaultdict
 import hashlib
+import ntpath
 
 # todo shell python bash pwsh
 
 try:
     from .parsemacro import parse_macro, ParseMacroError
     from .Opts import Opts, copy_opts
-    from .parsescript import parse_script, ON_PUSH, ON_TAG, ON_RELEASE, MACRO_NAMES, DEPRECATED_MACRO_NAMES, Script, Function
+    from .parsescript import parse_script, ON_PUSH, ON_TAG, ON_RELEASE, Script, Function
+    from .registry import registry, macro
+    from .labels import optimize
+    from .profiling import profiler
+    from . import matrix as matrix_
 except ImportError:
     from parsemacro import parse_macro, ParseMacroError
     from Opts import Opts, copy_opts
-    from parsescript import parse_script, ON_PUSH, ON_TAG, ON_RELEASE, MACRO_NAMES, DEPRECATED_MACRO_NAMES, Script, Function
+    from parsescript import parse_script, ON_PUSH, ON_TAG, ON_RELEASE, Script, Function
+    from registry import registry, macro
+    from labels import optimize
+    from profiling import profiler
+    import matrix as matrix_
 
 WARNING = 'This file is generated from {}, all edits will be lost'
 
@@ -59,6 +68,11 @@ class GithubCacheStep:
     path: list[str]
     key: str
 
+@dataclass
+class GithubDownload:
+    url: str
+    dest: str
+
 @dataclass
 class GithubMatrix:
     matrix: dict = field(default_factory=dict)
@@ -76,11 +90,29 @@ class GithubData:
     setup_java: GithubSetupJava = None
     steps: list = field(default_factory=list)
     cache: list[GithubCacheStep] = field(default_factory=list)
+    downloads: list[GithubDownload] = field(default_factory=list)
 
 @dataclass
 class Ctx:
     github: bool
     shell: str
+    prefetch: str = None
+    workspace: bool = False
+
+@dataclass
+class Prefetch:
+    url: str
+    dest: str
+    prefix: str
+    cache: bool
+    test: bool
+    insecure: bool
+
+@dataclass
+class CompileResult:
+    dst_paths: list[str] = field(default_factory=list)
+    includes: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
 
 def get_dst_bat(src):
     dirname = os.path.dirname(src)
@@ -94,12 +126,11 @@ def get_dst_workflow(src):
 
 class folded_str(str): pass
 class literal_str(str): pass
+# libyaml emitter accepts only exact str values
 def folded_str_representer(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='>')
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='>')
 def literal_str_representer(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
-yaml.add_representer(folded_str, folded_str_representer)
-yaml.add_representer(literal_str, literal_str_representer)
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='|')
 
 def str_or_literal(items):
     if len(items) == 1 and '%' not in items[0]:
@@ -127,8 +158,7 @@ def make_upload_step(data: GithubUpload):
         }
     }
 
-def save_workflow(path, steps, opts: Opts, githubdata: GithubData):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+def make_workflow(steps, opts: Opts, githubdata: GithubData, jobs = None):
     on = opts.github_on
     if on == ON_TAG:
         on_ = {"push":{"tags":"*"}}
@@ -137,21 +167,32 @@ def save_workflow(path, steps, opts: Opts, githubdata: GithubData):
     elif on == ON_RELEASE:
         on_ = {"release": {"types": ["created"]}}
 
-    main = {"runs-on":opts.github_image}
-
     matrix = githubdata.matrix.matrix
     include = githubdata.matrix.include
     exclude = githubdata.matrix.exclude
 
+    strategy = None
     if len(matrix) > 0 or len(include) > 0:
         strategy = {"matrix": matrix, "fail-fast": False}
         if len(include) > 0:
             strategy["matrix"]["include"] = include
         if len(exclude) > 0:
             strategy["matrix"]["exclude"] = exclude
-        main["strategy"] = strategy
 
-    main['steps'] = steps
+    def make_job(steps, needs=None):
+        job = {"runs-on":opts.github_image}
+        if needs is not None:
+            job["needs"] = needs
+        if strategy is not None:
+            # separate copy for each job, shared objects are dumped as yaml anchors
+            job["strategy"] = copy.deepcopy(strategy)
+        job['steps'] = steps
+        return job
+
+    if jobs is None:
+        jobs = {"main": make_job(steps)}
+    else:
+        jobs = {name: make_job(job["steps"], job.get("needs")) for name, job in jobs.items()}
 
     data = {"name":opts.workflow_name, "on":on_}
 
@@ -161,10 +202,22 @@ def save_workflow(path, steps, opts: Opts, githubdata: GithubData):
             "CHERE_INVOKING": 'yes'
         }
 
-    data["jobs"] = {"main": main}
+    data["jobs"] = jobs
+    return data
+
+def save_workflow(path, workflow):
+    """
+    Returns True if file was written
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with profiler.phase('yaml_dump'):
+        text = yaml_dump(workflow)
+    with profiler.phase('write'):
+        return write_if_changed(path, text, 'utf-8')
 
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(yaml.dump(data, None, Dumper=Dumper, sort_keys=False))
+def yaml_dump(data):
+    import yaml
+    return yaml.dump(data, None, Dumper=get_dumper(data), sort_keys=False)
 
 def make_checkout_step():
     return {"name": "checkout", "uses": "actions/checkout@v4"}
@@ -298,7 +351,7 @@ def render_function(function: Function, opts: Opts, github_data: GithubData):
     opts = copy_opts(opts)
     github = True
     name = function._name
-    lines = expand_macros(name, function._body, opts, github, github_data)
+    lines = expand_macros(name, function._body, opts, github, github_data, function_macros(function), function._origins)
     head = []
     append_path_var(opts, head)
     #print('render_function', function._name, opts.need_patch_var)
@@ -306,15 +359,16 @@ def render_function(function: Function, opts: Opts, github_data: GithubData):
         head += expand_macros(name, ['PATCH = find_app(C:\\Program Files\\Git\\usr\\bin\\patch.exe)\n'], opts)
     lines = head + lines
     lines = [re.sub('[ ]+$', '', line) for line in lines] # replace trailing spaces
+    if opts.timing:
+        res.append(TIMING_BEGIN)
     res.append(":{}_begin\n".format(name))
     res.append("".join(lines))
     res.append(":{}_end\n".format(name))
+    if opts.timing:
+        res.append(render_github_timing_end(name))
     res.append("\n")
-    while(True):
-        ok1 = remove_unused_labels(res)
-        ok2 = remove_redundant_gotos(res)
-        if not ok1 and not ok2:
-            break
+    with profiler.phase('optimize'):
+        optimize(res)
     return "".join(res)
 
 def dedent(text):
@@ -346,17 +400,350 @@ def insert_after(a, b, keys):
     keys.insert(keys.index(b) + 1, a)
     return True
 
-def render_local_main(script: Script, opts: Opts, src_name, echo_off=True, warning=True):
+DIR_RX = re.compile('^\\s*(cd|chdir|pushd|popd)\\b', re.IGNORECASE)
+JUMP_RX = re.compile('^\\s*:[0-9a-z_]|\\b(goto|exit)\\b', re.IGNORECASE)
+EXIT_MACROS = {'return', 'if_exist_return', 'find_app', 'where', 'assert'}
+# lines that can change variables or create directories used by downloads below them
+SETUP_RX = re.compile('\\b(set|setx|mkdir|md)\\s', re.IGNORECASE)
+SETUP_MACROS = {'set_var', 'set_path', 'mkdir'}
+
+def prefetch_positions(script: Script, keys, thens):
+    """
+    Finds download() calls that can be moved to the top of the script: unconditional,
+    not after jumps in the same def, not after lines that set variables or create directories,
+    without variables in url and dest and made from known directory (initial or script dir after pushd_cd()).
+    Returns name -> {line index: dest prefix}.
+    """
+    res = defaultdict(dict)
+    dirs = ['']
+    for name in keys:
+        function = script.function(name)
+        macros = function_macros(function)
+        conditional = function._condition is not None or function._shell not in [None, 'cmd']
+        depth = 0
+        jumped = False
+        changed = False
+        for i, line in enumerate(function._body):
+            macro = macros[i]
+            macroname = macro[1] if macro is not None else None
+            if macroname == 'if_arg':
+                return res
+            if macroname == 'pushd_cd':
+                if conditional or depth > 0:
+                    return res
+                dirs.append('%~dp0')
+                changed = True
+            elif macroname == 'popd_cd':
+                if conditional or depth > 0 or len(dirs) < 2:
+                    return res
+                dirs.pop()
+                changed = True
+            elif macro is None and DIR_RX.match(line):
+                return res
+            elif macroname in SETUP_MACROS or (macro is not None and macro[0] is not None) or (macro is None and SETUP_RX.search(line)):
+                return res
+            elif macroname in EXIT_MACROS or (macro is None and JUMP_RX.search(line)):
+                jumped = True
+            elif macroname == 'download' and not conditional and not jumped and depth == 0:
+                if not any('%' in arg for arg in macro[2][:2]):
+                    res[name][i] = dirs[-1]
+            if macro is None:
+                stripped = line.strip()
+                if stripped.startswith(')'):
+                    depth -= 1
+                if stripped.endswith('('):
+                    depth += 1
+        if jumped and changed:
+            return res
+        if thens.get(name) == 'exit':
+            return res
+    return res
+
+def render_prefetch(opts: Opts):
+    """
+    Downloads are written into curl config files at runtime (so cached files are skipped)
+    and fetched by one curl call per config
+    """
+    # use_curl() was called by download() already
+    curl = '"%CURL%"' if opts.env_policy else 'curl'
+    proxy, user_agent = curl_options(opts)
+    res = []
+    if any(item.prefix != '' for item in opts.prefetch):
+        res.append('set PBAT_DIR=%~dp0\n')
+        res.append('set PBAT_DIR=%PBAT_DIR:\\=/%\n')
+    def config_value(s):
+        return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    for insecure in [False, True]:
+        items = [item for item in opts.prefetch if item.insecure == insecure]
+        if len(items) == 0:
+            continue
+        config = '%TEMP%\\pbat_downloads{}_%RANDOM%.txt'.format('_k' if insecure else '')
+        res.append('set PBAT_DOWNLOADS={}\n'.format(config))
+        for item in items:
+            dest = item.prefix + item.dest
+            output = '%PBAT_DIR%' + item.dest.replace('\\', '/') if item.prefix != '' else item.dest.replace('\\', '/')
+            echo = "    echo url = {}\n    echo output = {}\n".format(config_value(item.url), config_value(output))
+            if item.test:
+                res.append('7z t {} > NUL || del /f {}\n'.format(quoted(dest), quoted(dest)))
+            if item.cache:
+                res.append('if not exist {} (\n{}) >> "%PBAT_DOWNLOADS%"\n'.format(quoted(dest), echo))
+            else:
+                res.append('(\n{}) >> "%PBAT_DOWNLOADS%"\n'.format(echo))
+        cmd = spacejoin_nonempty(curl, '--parallel', '--parallel-max', str(opts.parallel_downloads), '--create-dirs', '-L', proxy, user_agent, '-k' if insecure else '', '-K', '"%PBAT_DOWNLOADS%"')
+        res.append('if exist "%PBAT_DOWNLOADS%" (\n    {}\n    del /f "%PBAT_DOWNLOADS%"\n)\n'.format(cmd))
+    return res
+
+FETCH = """:pbat_fetch
+if exist "%~2" (
+    call :pbat_sha256 "%~2" "%~4" && exit /b 0
+    del /f "%~2"
+)
+if not defined PBAT_CACHE goto pbat_fetch_direct
+if not exist "%PBAT_CACHE%" mkdir "%PBAT_CACHE%"
+set PBAT_RC=
+:pbat_fetch_lock
+2> NUL (
+    9> "%PBAT_CACHE%\\%~3.lock" call :pbat_fetch_shared %*
+)
+if not defined PBAT_RC (
+    ping -n 2 127.0.0.1 > NUL
+    goto pbat_fetch_lock
+)
+if "%PBAT_RC%" neq "0" exit /b 1
+mklink /h "%~2" "%PBAT_CACHE%\\%~3" > NUL 2>&1 || copy /y "%PBAT_CACHE%\\%~3" "%~2" > NUL
+exit /b
+:pbat_fetch_shared
+set PBAT_RC=1
+if exist "%PBAT_CACHE%\\%~3" (
+    call :pbat_sha256 "%PBAT_CACHE%\\%~3" "%~4" && (
+        set PBAT_RC=0
+        exit /b 0
+    )
+    del /f "%PBAT_CACHE%\\%~3"
+)
+call :pbat_fetch_url "%~1" "%PBAT_CACHE%\\%~3" "%~4" "%~5" || exit /b 1
+set PBAT_RC=0
+exit /b 0
+:pbat_fetch_direct
+call :pbat_fetch_url "%~1" "%~2" "%~4" "%~5"
+exit /b
+:pbat_fetch_url
+echo downloading %~nx2
+{} %~4 -o "%~2.part" "%~1" || (
+    if exist "%~2.part" del /f "%~2.part"
+    exit /b 1
+)
+call :pbat_sha256 "%~2.part" "%~3" || (
+    del /f "%~2.part"
+    exit /b 1
+)
+move /y "%~2.part" "%~2" > NUL
+exit /b
+:pbat_sha256
+if "%~2" equ "" exit /b 0
+certutil -hashfile "%~1" SHA256 | findstr /i /x /c:"%~2" > NUL && exit /b 0
+echo %~1: sha256 mismatch
+exit /b 1
+"""
+
+def render_fetch(opts: Opts):
+    """
+    Subroutine called by download() with :sha256 or :shared:
+    call :pbat_fetch url dest key sha256 curl-flags
+    Existing dest is kept if its hash matches, with %PBAT_CACHE% set file is downloaded once
+    into cache (under lock file, so concurrent builds wait for each other) and hard-linked or copied to dest.
+    Files are downloaded to .part and renamed after verification, truncated file is never trusted.
+    """
+    curl = '"%CURL%"' if opts.env_policy else 'curl'
+    proxy, user_agent = curl_options(opts)
+    # one level deeper, script is dedented as a whole
+    return textwrap.indent(FETCH.format(spacejoin_nonempty(curl, '-f', '-L', proxy, user_agent)), '    ')
+
+TIMING_BEGIN = 'set "PBAT_BEGIN_TIME=%TIME: =0%"\n'
+
+# expects PBAT_DEF, PBAT_CODE and PBAT_BEGIN_TIME, time is in centiseconds since midnight
+TIMING_END = """set "PBAT_END_TIME=%TIME: =0%"
+for /f "tokens=1-4 delims=:.," %%a in ("%PBAT_BEGIN_TIME%") do set /a "PBAT_BEGIN=(((1%%a-100)*60+1%%b-100)*60+1%%c-100)*100+1%%d-100"
+for /f "tokens=1-4 delims=:.," %%a in ("%PBAT_END_TIME%") do set /a "PBAT_END=(((1%%a-100)*60+1%%b-100)*60+1%%c-100)*100+1%%d-100"
+set /a PBAT_CS=PBAT_END-PBAT_BEGIN
+if %PBAT_CS% lss 0 set /a PBAT_CS+=8640000
+set /a PBAT_SEC=PBAT_CS/100, PBAT_CS=100+PBAT_CS%%100
+set PBAT_SEC=%PBAT_SEC%.%PBAT_CS:~1%
+"""
+
+TIMING_RECORD = '>> "%PBAT_TIMING%" echo {"def": "%PBAT_DEF%", "begin": "%PBAT_BEGIN_TIME%", "end": "%PBAT_END_TIME%", "seconds": %PBAT_SEC%, "code": %PBAT_CODE%}\n'
+
+def render_timing():
+    """
+    Subroutine called at the end of each def: call :pbat_timing_end name exitcode
+    Appends json line to %PBAT_TIMING% (retried, parallel defs write to the same file) and preserves exit code
+    """
+    res = [':pbat_timing_end\n', 'set PBAT_DEF=%~1\n', 'set PBAT_CODE=%~2\n', TIMING_END, 'set PBAT_TRY=0\n']
+    res.append(':pbat_timing_write\n')
+    res.append('2> NUL (\n    ' + TIMING_RECORD + ') && exit /b %PBAT_CODE%\n')
+    res.append('set /a PBAT_TRY+=1\n')
+    res.append('if %PBAT_TRY% lss 20 goto pbat_timing_write\n')
+    res.append('exit /b %PBAT_CODE%\n')
+    # one level deeper, script is dedented as a whole
+    return textwrap.indent("".join(res), '    ')
+
+def render_stamp():
+    """
+    Subroutine called at the end of each succeeded def in parallel mode: call :pbat_stamp name hash
+    Appends stamp to %PBAT_STATE% (retried as in render_timing(), parallel defs write to the same file)
+    """
+    res = [':pbat_stamp\n', 'set PBAT_TRY=0\n', ':pbat_stamp_write\n']
+    res.append('2> NUL (\n    >> "%PBAT_STATE%" echo %~1 %~2\n) && exit /b 0\n')
+    res.append('set /a PBAT_TRY+=1\n')
+    res.append('if %PBAT_TRY% lss 20 goto pbat_stamp_write\n')
+    res.append('exit /b 0\n')
+    # one level deeper, script is dedented as a whole
+    return textwrap.indent("".join(res), '    ')
+
+def render_github_timing_end(name):
+    """
+    Inline version for github step: json line and markdown table row are written into runner temp dir,
+    table is added to job summary by make_timing_summary_step() and json lines are uploaded by make_timing_upload_step()
+    """
+    res = ['set PBAT_CODE=%ERRORLEVEL%\n', 'set PBAT_DEF={}\n'.format(name), 'set PBAT_TIMING=%RUNNER_TEMP%\\pbat_timing.jsonl\n', TIMING_END, TIMING_RECORD]
+    res.append('>> "%RUNNER_TEMP%\\pbat_timing.md" echo ^| %PBAT_DEF% ^| %PBAT_SEC% ^| %PBAT_CODE% ^|\n')
+    res.append('exit /b %PBAT_CODE%\n')
+    return "".join(res)
+
+def make_timing_upload_step():
+    # artifact names must be unique within run, every job (and matrix job) uploads its own log
+    return {
+        "name": "upload timing",
+        "if": "always()",
+        "uses": "actions/upload-artifact@v4",
+        "with": {
+            "name": "timing-${{ github.job }}-${{ strategy.job-index }}",
+            "path": "${{ runner.temp }}\\pbat_timing.jsonl",
+            "if-no-files-found": "ignore"
+        }
+    }
+
+def make_timing_summary_step():
+    run = [
+        '>> "%GITHUB_STEP_SUMMARY%" echo ^| def ^| seconds ^| exit code ^|',
+        '>> "%GITHUB_STEP_SUMMARY%" echo ^|---^|---:^|---:^|',
+        'if exist "%RUNNER_TEMP%\\pbat_timing.md" type "%RUNNER_TEMP%\\pbat_timing.md" >> "%GITHUB_STEP_SUMMARY%"'
+    ]
+    return {
+        "name": "timing",
+        "if": "always()",
+        "shell": "cmd",
+        "run": str_or_literal(run)
+    }
+
+def render_resume(stamps):
+    """
+    Completed defs are stamped with name and hash of rendered body into state file,
+    with resume argument script jumps to first def without valid stamp
+    """
+    res = ['set PBAT_STATE=%~dpn0.state\n']
+    tests = "".join(['        findstr /x /c:"{}" "%PBAT_STATE%" > NUL || goto {}_begin\n'.format(stamp, name) for name, stamp in stamps])
+    res.append('if "%~1" equ "resume" (\n    if exist "%PBAT_STATE%" (\n' + tests + '        echo all steps are completed\n        exit /b\n    )\n)\n')
+    res.append('if exist "%PBAT_STATE%" del /f "%PBAT_STATE%"\n')
+    return res
+
+PARALLEL_LOOP = """:pbat_loop
+set /a PBAT_STARTED=0, PBAT_DONE=0
+for %%i in ("%PBAT_RUN%\\*.started") do set /a PBAT_STARTED+=1
+for %%i in ("%PBAT_RUN%\\*.done") do set /a PBAT_DONE+=1
+if not exist "%PBAT_RUN%\\*.failed" (
+{})
+if %PBAT_DONE% lss %PBAT_STARTED% (
+    ping -n 2 127.0.0.1 > NUL
+    goto pbat_loop
+)
+set PBAT_CODE=0
+for %%i in ("%PBAT_RUN%\\*.failed") do (
+    echo %%~ni failed
+    set PBAT_CODE=1
+)
+rmdir /s /q "%PBAT_RUN%"
+exit /b %PBAT_CODE%
+"""
+
+PARALLEL_START = """:pbat_start
+set /a PBAT_RUNNING=PBAT_STARTED-PBAT_DONE
+if %PBAT_RUNNING% geq %PBAT_JOBS% exit /b
+type nul > "%PBAT_RUN%\\%1.started"
+set /a PBAT_STARTED+=1
+start "" /b cmd /c ""%PBAT_SELF%" pbat_run %1"
+exit /b
+"""
+
+PARALLEL_SKIP = """:pbat_skip
+type nul > "%PBAT_RUN%\\%1.started"
+type nul > "%PBAT_RUN%\\%1.ok"
+type nul > "%PBAT_RUN%\\%1.done"
+exit /b
+"""
+
+PARALLEL_RUN = """:pbat_run
+{}set PBAT_CODE=%errorlevel%
+if %PBAT_CODE% neq 0 > "%PBAT_RUN%\\%~2.failed" echo %PBAT_CODE%
+if %PBAT_CODE% equ 0 type nul > "%PBAT_RUN%\\%~2.ok"
+type nul > "%PBAT_RUN%\\%~2.done"
+exit /b %PBAT_CODE%
+"""
+
+def render_parallel(keys, preds, jobs, stamps, variants=False):
+    """
+    Scheduler loop that starts each def as separate `start /b` process of the same script
+    as soon as its predecessors succeed, up to jobs processes at once.
+    Progress is kept in marker files: name.started, name.done and name.ok or name.failed (with exit code)
+    """
+    def marker(name, ext):
+        return '"%PBAT_RUN%\\{}.{}"'.format(name, ext)
+
+    def ready(name):
+        return "".join(['if exist {} '.format(marker(dep, 'ok')) for dep in preds[name]])
+
     res = []
+    res.append('set PBAT_SELF=%~f0\n')
+    res.append('set PBAT_JOBS={}\n'.format(jobs))
+    res.append('set PBAT_RUN=%TEMP%\\pbat_%RANDOM%_%RANDOM%\n')
+    res.append('mkdir "%PBAT_RUN%"\n')
+    if stamps is not None:
+        # stamped defs are marked as done unless any of predecessors runs again
+        res.append('set PBAT_STATE=%~dpn0.state\n')
+        tests = "".join(['        findstr /x /c:"{}" "%PBAT_STATE%" > NUL && {}call :pbat_skip {}\n'.format(stamp, ready(name), name) for name, stamp in stamps])
+        res.append('if "%~1" equ "resume" (\n    if exist "%PBAT_STATE%" (\n' + tests + '    )\n)\n')
+        res.append('if "%~1" neq "resume" if exist "%PBAT_STATE%" del /f "%PBAT_STATE%"\n')
+    starts = "".join(['    if not exist {} {}call :pbat_start {}\n'.format(marker(name, 'started'), ready(name), name) for name in keys])
+    res.append(PARALLEL_LOOP.format(starts))
+    res.append(PARALLEL_START)
+    if stamps is not None:
+        res.append(PARALLEL_SKIP)
+    if variants:
+        calls = "".join(['if "%~2" equ "{}" call "%~dpn0-{}.bat"\n'.format(name, name) for name in keys])
+    else:
+        calls = "".join(['if "%~2" equ "{}" call :{}_begin\n'.format(name, name) for name in keys])
+    res.append(PARALLEL_RUN.format(calls))
+    return res
 
-    keys, thens = script.compute_order()
+def render_local_main(script: Script, opts: Opts, src_name, echo_off=True, warning=True, order=None, githubdata=None):
+    res = []
+
+    if order is None:
+        order = script.compute_order()
+    keys, thens = order
+    stamps = []
+    prefetch = dict()
+    if opts.parallel_downloads:
+        prefetch = prefetch_positions(script, keys, thens)
     for name in keys:
         function = script.function(name)
-        lines = expand_macros(name, function._body, opts, False)
+        lines = expand_macros(name, function._body, opts, False, githubdata, function_macros(function), function._origins, prefetch.get(name, dict()))
         #res.append("rem def {}\n".format(name))
         res.append(":{}_begin\n".format(name))
         if opts.debug:
             res.append("echo {}\n".format(name))
+        if opts.timing:
+            res.append(TIMING_BEGIN)
             #res.append(macro_log(name, [name]))
         shell = function._shell
         if shell is None:
@@ -366,8 +753,23 @@ def render_local_main(script: Script, opts: Opts, src_name, echo_off=True, warni
         else:
             raise Exception('not implemented')
         res.append(":{}_end\n".format(name))
+        if opts.checkpoint:
+            stamp = "{} {}".format(name, hashlib.sha1("".join(lines).encode('utf-8')).hexdigest()[:12])
+            stamps.append((name, stamp))
+            # failed def is not stamped and runs again on resume
+            if opts.parallel:
+                res.append('if not errorlevel 1 call :pbat_stamp {}\n'.format(stamp))
+            else:
+                res.append('if not errorlevel 1 >> "%PBAT_STATE%" echo {}\n'.format(stamp))
+        if opts.timing:
+            res.append('call :pbat_timing_end {} %ERRORLEVEL%\n'.format(name))
         goto = None
-        if name in thens:
+        if opts.parallel:
+            # def is called from pbat_run, errorlevel of last command is its exit code
+            if thens.get(name) == 'exit' and name != keys[-1]:
+                raise ValueError("{} then exit is not supported with parallel".format(name))
+            goto = "exit /b\n"
+        elif name in thens:
             if thens[name] != 'exit':
                 goto = "goto {}_begin\n".format(thens[name])
         if goto is None:
@@ -391,109 +793,40 @@ def render_local_main(script: Script, opts: Opts, src_name, echo_off=True, warni
     if opts.need_curl_var:
         head += expand_macros(name, ['CURL = find_app(C:\\Windows\\System32\\curl.exe, C:\\Program Files\\Git\\mingw64\\bin\\curl.exe, C:\\Program Files\\Git\\mingw32\\bin\\curl.exe)\n'], opts)
 
-    files = []
+    if opts.timing:
+        head.append('if not defined PBAT_TIMING set PBAT_TIMING=%~dpn0.timing.jsonl\n')
 
-    res = head + res
+    if opts.parallel:
+        head.append('if "%~1" equ "pbat_run" goto pbat_run\n')
 
-    while(True):
-        ok1 = remove_unused_labels(res)
-        ok2 = remove_redundant_gotos(res)
-        if not ok1 and not ok2:
-            break
+    if len(opts.prefetch) > 0:
+        head += render_prefetch(opts)
 
-    return "".join(res), files
+    if opts.parallel:
+        head += render_parallel(keys, script.predecessors(keys), opts.parallel, stamps if opts.checkpoint else None)
+    elif opts.checkpoint:
+        head += render_resume(stamps)
 
-def remove_unused_labels(res):
-    #print('remove_unused_labels')
-    changed = False
-    gotos = []
-    goto_rx = re.compile('goto\\s*([0-9a-z_]+)', re.IGNORECASE)
-    label_rx = re.compile('^:([0-9a-z_]+)', re.IGNORECASE)
-    call_rx = re.compile('call\\s*:([0-9a-z_]+)', re.IGNORECASE)
-
-    for line in res:
-        for m in goto_rx.findall(line):
-            gotos.append(m)
-        for m in call_rx.findall(line):
-            gotos.append(m)
-
-    for i, line in enumerate(res):
-        m = label_rx.match(line)
-        if m:
-            if m.group(1) not in gotos:
-                res[i] = ""
-                changed = True
-    return changed
-
-def remove_redundant_gotos(res):
-    #print('remove_redundant_gotos')
-    goto_rx = re.compile('goto ([0-9a-z_]+)', re.IGNORECASE)
-    label_rx = re.compile('^:([0-9a-z_]+)', re.IGNORECASE)
-    changed = False
-    ixs = [i for i, line in enumerate(res) if goto_rx.match(line)]
-    for i in ixs:
-        goto = goto_rx.match(res[i]).group(1)
-        if goto == 'end':
-            res[i] = "exit /b\n"
-            changed = True
-            continue
-        for j in range(i+1, len(res)):
-            line = res[j]
-            if line.strip() == "":
-                continue
-            m = label_rx.match(line)
-            if m:
-                label = m.group(1)
-                if label == goto:
-                    res[i] = ""
-                    changed = True
-            break
+    if opts.need_fetch:
+        res.append(render_fetch(opts))
 
-    # trim extra exits at the end of the file
-    for i in reversed(range(len(res))):
-        line = res[i].strip()
-        if line == "exit /b":
-            res[i] = ""
-            changed = True
-        elif line == "":
-            pass
-        else:
-            #print(i, line)
-            break
+    if opts.checkpoint and opts.parallel:
+        res.append(render_stamp())
 
-    return changed
+    if opts.timing:
+        res.append(render_timing())
 
-def validate_args(fnname, args, kwargs, ret, argmin = None, argmax = None, kwnames = None, needret = False):
+    files = []
 
-    argmin_ = argmin is not None and argmin > -1
-    argmax_ = argmax is not None and argmax > -1
+    res = head + res
 
-    if argmin_ and argmax_:
-        if not (argmin <= len(args) <= argmax):
-            if argmin == argmax:
-                nargs = str(argmin)
-            else:
-                nargs = "{} to {}".format(argmin, argmax)
-            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
-    elif argmin_:
-        if len(args) < argmin:
-            nargs = "{} or more".format(argmin)
-            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
-    elif argmax_:
-        if len(args) > argmax:
-            nargs = "{} or less".format(argmin)
-            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
-
-    if kwnames is not None:
-        for n in kwargs:
-            if n not in kwnames:
-                raise Exception("{} unknown option {}".format(fnname, n))
-    if needret and ret is None:
-        raise Exception("{} must be assigned to env variable".format(fnname))
+    with profiler.phase('optimize'):
+        optimize(res)
+
+    return "".join(res), files
 
+@macro('find_app', 1, None, {"g", "goto", "c", "cmd"}, True)
 def macro_find_app(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    
-    validate_args("find_app", args, kwargs, ret, 1, None, {"g", "goto", "c", "cmd"}, True)
 
     err_goto = kwarg_value(kwargs, 'goto', 'g')
     err_cmd = kwarg_value(kwargs, 'cmd', 'c')
@@ -537,26 +870,11 @@ def quoted(s):
 def escape_url(s):
     return quoted("".join(["^" + c if c == '%' else c for c in s]))
 
+@macro('return')
 def macro_return(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     return 'goto {}_end'.format(name)
 
-def macro_download(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-
-    url = args[0]
-
-    if len(args) > 1:
-        dest = args[1]
-    else:
-        dest = os.path.basename(url).split('?')[0]
-
-    shell = ctx.shell
-
-    cache = kwarg_value(kwargs, 'cache', 'c')
-
-    verbose = kwarg_value(kwargs, 'verbose', 'v')
-
-    test = kwarg_value(kwargs, 'test', 't')
-
+def use_curl(ctx, opts):
     if opts.env_policy and not ctx.github:
         curl = '"%CURL%"'
         opts.need_curl_var = True
@@ -566,7 +884,9 @@ def macro_download(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gi
             #opts.env_path.append('C:\\Program Files\\Git\\mingw64\\bin')
             #opts.env_path.append('C:\\Program Files\\Git\\mingw32\\bin')
             opts.env_path.append('C:\\Windows\\System32')
-    
+    return curl
+
+def curl_options(opts):
     user_agent = ""
     if opts.curl_user_agent is not None:
         user_agent = '--user-agent "' + {
@@ -578,20 +898,77 @@ def macro_download(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gi
     proxy = ''
     if opts.curl_proxy is not None:
         proxy = '-x {}'.format(opts.curl_proxy)
+    return proxy, user_agent
+
+def spacejoin_nonempty(*vs):
+    return " ".join([v for v in vs if v != ""])
+
+@macro('download')
+def macro_download(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
+
+    url = args[0]
+
+    if len(args) > 1:
+        dest = args[1]
+    else:
+        dest = os.path.basename(url).split('?')[0]
+
+    shell = ctx.shell
+
+    cache = kwarg_value(kwargs, 'cache', 'c')
+
+    verbose = kwarg_value(kwargs, 'verbose', 'v')
+
+    test = kwarg_value(kwargs, 'test', 't')
+
+    curl = use_curl(ctx, opts)
+    proxy, user_agent = curl_options(opts)
 
     #print("user_agent", user_agent)
 
     is_wget = False
     is_curl = True
 
-    def spacejoin_nonempty(*vs):
-        return " ".join([v for v in vs if v != ""])
-
     if kwarg_value(kwargs, 'k'):
         insecure = '-k'
     else:
         insecure = ''
 
+    sha256 = kwarg_value(kwargs, 'sha256')
+    shared = kwarg_value(kwargs, 'shared')
+
+    if ctx.prefetch is not None and opts.parallel_downloads and shell == 'cmd' and sha256 is None and not shared:
+        # hoisted into parallel curl call at the top of the script
+        test_ = cache is not None and test and os.path.splitext(dest)[1].lower() in ['.7z', '.zip']
+        prefix = ctx.prefetch
+        if ntpath.isabs(dest) or dest.startswith('%'):
+            prefix = ''
+        opts.prefetch.append(Prefetch(url, dest, prefix, cache is not None, bool(test_), insecure != ''))
+        return '\n'
+
+    if sha256 is not None:
+        if not re.match('^[0-9a-fA-F]{64}$', sha256):
+            raise ValueError("download() sha256 must be 64 hex digits, got {}".format(sha256))
+        sha256 = sha256.lower()
+
+    if (sha256 is not None or shared) and shell == 'cmd' and not ctx.github:
+        # shared cache is addressed by hash or by url
+        opts.need_fetch = True
+        basename = ntpath.basename(dest)
+        if sha256 is not None:
+            key = "{}_{}".format(sha256[:16], basename)
+        else:
+            key = "{}_{}".format(hashlib.sha1(url.encode('utf-8')).hexdigest()[:16], basename)
+        return 'call :pbat_fetch "{}" "{}" "{}" "{}" "{}" || exit /b 1\n'.format(url, dest, key, sha256 or '', insecure)
+
+    if shared and shell != 'cmd':
+        raise MacroError("download() :shared is not implemented for shell {}".format(shell))
+
+    if ctx.github and cache is not None and shell == 'cmd' and '%' not in dest:
+        # restored by actions/cache step, path must be relative to workspace or absolute
+        if ctx.workspace or ntpath.isabs(dest):
+            githubdata.downloads.append(GithubDownload(url, dest))
+
     if is_curl:
         cmd = spacejoin_nonempty(curl, '-L', proxy, user_agent, insecure, '-o', quoted(dest), quoted(url)) + "\n"
     elif is_wget:
@@ -609,11 +986,15 @@ def macro_download(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gi
 
             if test and os.path.splitext(dest)[1].lower() in ['.7z', '.zip']:
                 exp = '7z t {} > NUL || del /f {}\n'.format(quoted(dest), quoted(dest)) + exp
+        if sha256 is not None:
+            exp += 'certutil -hashfile {} SHA256 | findstr /i /x /c:"{}" > NUL || (\n    echo {}: sha256 mismatch\n    exit /b 1\n)\n'.format(quoted(dest), sha256, dest)
     elif shell == 'msys2':
         if cache is None:
             exp = cmd
         else:
             exp = "if [ ! -f {} ]; then {}; fi\n".format(quoted(dest), cmd)
+        if sha256 is not None:
+            exp += 'echo "{}  {}" | sha256sum -c --quiet - || exit 1\n'.format(sha256, dest)
     else:
         raise Exception('not implemented for shell {}'.format(shell))
 
@@ -634,6 +1015,7 @@ def use_cmake(ctx, opts):
 def use_ninja(ctx, opts):
     pass
 
+@macro('unzip')
 def macro_unzip(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
 
     use_7z(ctx, opts)
@@ -664,22 +1046,20 @@ def macro_unzip(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Githu
 
     return exp
 
+COMPRESSION_MODE = {
+    "-mx0": "copy",
+    "-mx1": "fastest",
+    "-mx3": "fast",
+    "-mx5": "normal",
+    "-mx7": "maximum",
+    "-mx9": "ultra"
+}
+
+@macro('zip', 2, None, list(COMPRESSION_MODE.values()) + ["lzma", "test", "clean"], False)
 def macro_zip(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
 
     use_7z(ctx, opts)
 
-    COMPRESSION_MODE = {
-        "-mx0": "copy",
-        "-mx1": "fastest",
-        "-mx3": "fast",
-        "-mx5": "normal",
-        "-mx7": "maximum",
-        "-mx9": "ultra"
-    }
-    kwnames = list(COMPRESSION_MODE.values()) + ["lzma", "test", "clean"]
-
-    validate_args("zip", args, kwargs, ret, 2, None, kwnames, False)
-
     dst, src = args[0], args[1:]
     zip = '7z'
     
@@ -701,8 +1081,8 @@ def macro_zip(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubD
 
     return " ".join(cmd) + "\n"
 
+@macro('patch', 1, 1, {"N", "forward", "p1"})
 def macro_patch(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("patch", args, kwargs, ret, 1, 1, {"N", "forward", "p1"})
 
     opts.use_patch = True
     if opts.env_policy or opts.use_patch_var:
@@ -723,14 +1103,17 @@ def macro_patch(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Githu
     cmd = cmd + ["-i", quoted(args[0])]
     return " ".join(cmd) + "\n"
     
+@macro('mkdir')
 def macro_mkdir(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     arg = args[0]
     return "if not exist {} mkdir {}\n".format(quoted(arg), quoted(arg))
 
+@macro('log')
 def macro_log(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     arg = args[0]
     return "echo %DATE% %TIME% {} >> %~dp0log.txt\n".format(arg)
 
+@macro('rmdir')
 def macro_rmdir(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     arg = args[0]
     github = kwarg_value(kwargs, "github")
@@ -738,6 +1121,7 @@ def macro_rmdir(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Githu
         return '\n'
     return "if exist {} rmdir /s /q {}\n".format(quoted(arg), quoted(arg))
 
+@macro('test_exist')
 def macro_test_exist(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     path = args[0]
     return "if exist {} (\necho {} exist\n) else (\necho {} does not exist\n)\n".format(
@@ -756,6 +1140,7 @@ def if_group(cond, cmds):
 )
 """.format(cond, "\n    ".join(cmds))
 
+@macro('git_clone')
 def macro_git_clone(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     url = args[0]
     if len(args) > 1:
@@ -803,6 +1188,7 @@ popd
 
     return cmd
 
+@macro('git_pull')
 def macro_git_pull(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     base = args[0]
     return textwrap.dedent("""\
@@ -811,6 +1197,7 @@ def macro_git_pull(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gi
     popd
     """).format(base)
 
+@macro('set_path')
 def macro_set_path(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     """
     if ctx.github:
@@ -818,6 +1205,7 @@ def macro_set_path(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gi
     """
     return "set PATH=" + ";".join(args) + "\n"
 
+@macro('set_var')
 def macro_set_var(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     n, v = args
     res = []
@@ -833,13 +1221,13 @@ def macro_set_var(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Git
         raise Exception("set_var not implemented for shell {}".format(ctx.shell))
     return "".join(res)
 
+@macro('copy', 2, 2, set(), False)
 def macro_copy(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("copy", args, kwargs, ret, 2, 2, set(), False)
     src, dst = args
     return "copy /y {} {}\n".format(quoted(src), quoted(dst))
 
+@macro('move', 2, 2, ["github", "g", "i", "ignore-errors"], False)
 def macro_move(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("move", args, kwargs, ret, 2, 2, ["github", "g", "i", "ignore-errors"], False)
     github = kwarg_value(kwargs, "github", "g")
     ignore_errors = kwarg_value(kwargs, "ignore-errors", "i")
     src, dst = args
@@ -850,11 +1238,12 @@ def macro_move(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Github
         res.append("echo 1 > NUL")
     return " || ".join(res) + "\n"
 
+@macro('del')
 def macro_del(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     return "del /f /q " + " ".join([quoted(arg) for arg in args])
 
+@macro('xcopy', 2, 2, ['q'], False)
 def macro_xcopy(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("xcopy", args, kwargs, ret, 2, 2, ['q'], False)
     src, dst = args
     keys = ['s','e','y','i']
     q = kwargs.get('q')
@@ -864,6 +1253,7 @@ def macro_xcopy(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Githu
     return "xcopy {} {} {}\n".format(keys_, quoted(src), quoted(dst))
 
 
+@macro('call_vcvars')
 def macro_call_vcvars(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     if ctx.github:
         opts.env_path.append('C:\\Program Files\\Microsoft Visual Studio\\2022\\Enterprise\\VC\\Auxiliary\\Build')
@@ -873,12 +1263,14 @@ def macro_call_vcvars(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata:
 
     return 'call vcvars64.bat'
 
+@macro('if_exist_return')
 def macro_if_exist_return(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     if len(args) < 1:
         print("macro if_exist_return requires an argument")
         return ''
     return 'if exist {} goto {}_end'.format(quoted(args[0]), name)
 
+@macro('where')
 def macro_where(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     res = []
     assert_ = kwarg_value(kwargs, "assert", "a")
@@ -889,6 +1281,7 @@ def macro_where(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Githu
             res.append('where {} 2> NUL || echo {} not found'.format(n, n))
     return "\n".join(res) + "\n"
 
+@macro('assert')
 def macro_assert(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     lines1 = []
     lines2 = []
@@ -897,20 +1290,23 @@ def macro_assert(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gith
         lines2.append('where {} > NUL 2>&1 || exit /b\n'.format(arg, arg))
     return "\n".join(lines1) + "\n" + "\n".join(lines2) + "\n"
 
+@macro('if_arg')
 def macro_if_arg(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     value, defname = args
     return 'if "%1" equ "{}" goto {}_begin\n'.format(value, defname)
 
+@macro('github_release')
 def macro_github_release(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     githubdata.release.extend(args)
     return '\n'
 
+@macro('github_checkout')
 def macro_github_checkout(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     githubdata.checkout = True
     return '\n'
 
+@macro('github_upload', 1, None, {"n", "name"})
 def macro_github_upload(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("github_upload", args, kwargs, ret, 1, None, {"n", "name"})
     path = args
     upload_name = kwarg_value(kwargs, "n", "name")
     if upload_name is None:
@@ -924,6 +1320,7 @@ def macro_github_upload(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdat
     githubdata.upload.append(GithubUpload(upload_name, path))
     return '\n'
 
+@macro('github_cache')
 def macro_github_cache(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     step_name = kwarg_value(kwargs, "n", "name")
     paths = args
@@ -933,25 +1330,28 @@ def macro_github_cache(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata
     if step_name is None:
         step_name = "cache {}".format(" ".join(paths))
     if key is None:
-        key = hashlib.md5(";".join(paths)).digest().hex()
+        key = hashlib.md5(";".join(paths).encode('utf-8')).hexdigest()
     githubdata.cache.append(GithubCacheStep(step_name, paths, key))
     return '\n'
 
+@macro('github_matrix', 1, 1, set(), True)
 def macro_github_matrix(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("github_matrix", args, kwargs, ret, 1, 1, set(), True)
-    githubdata.matrix.matrix[ret] = args[0]
+    # parsed args are shared between calls (see parse_macros)
+    githubdata.matrix.matrix[ret] = list(args[0])
     return '\n'
 
+@macro('github_matrix_include')
 def macro_github_matrix_include(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    githubdata.matrix.include.append(kwargs)
+    githubdata.matrix.include.append(dict(kwargs))
     return '\n'
 
+@macro('github_matrix_exclude')
 def macro_github_matrix_exclude(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     githubdata.matrix.exclude.append(kwargs)
     return '\n'
 
+@macro('github_setup_msys2', None, None, {"m", "msystem", "u", "update", "r", "release"})
 def macro_github_setup_msys2(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("setup_msys2", args, kwargs, ret, None, None, {"m", "msystem", "u", "update", "r", "release"})
     install = args
     msystem = kwarg_value(kwargs, "m", "msystem")
     #install = kwarg_value(kwargs, "i", "install")
@@ -961,30 +1361,32 @@ def macro_github_setup_msys2(name, args, kwargs, ret, opts: Opts, ctx: Ctx, gith
     githubdata.setup_msys2 = GithubSetupMsys2(msystem, install, update, release)
     return '\n'
 
+@macro('github_setup_node', 1, 1, {})
 def macro_github_setup_node(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("setup_node", args, kwargs, ret, 1, 1, {})
     node_version = args[0]
     githubdata.setup_node = GithubSetupNode(node_version)
     return '\n'
 
+@macro('github_setup_java', 2, 2, {})
 def macro_github_setup_java(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("setup_java", args, kwargs, ret, 2, 2, {})
     distribution, java_version = args
     githubdata.setup_java = GithubSetupJava(distribution, java_version)
     return '\n'
 
+@macro('pushd_cd')
 def macro_pushd_cd(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     if ctx.github:
         return 'pushd %GITHUB_WORKSPACE%\n'
     return 'pushd %~dp0\n'
 
+@macro('popd_cd')
 def macro_popd_cd(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     if ctx.github:
         return '\n'
     return 'popd\n'
 
+@macro('substr', 2, 3, {}, True)
 def macro_substr(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("substr", args, kwargs, ret, 2, 3, {}, True)
     stop = None
     if len(args) == 3:
         varname, start, stop = args
@@ -996,8 +1398,8 @@ def macro_substr(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Gith
         ixs = stop
     return 'set {}=%{}:~{}%\n'.format(ret, varname, ixs)
 
+@macro('foreach', 2, -1, [])
 def macro_foreach(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
-    validate_args("foreach", args, kwargs, ret, 2, -1, [])
     vars = args[1:]
     res = []
     for i in range(len(vars[0])):
@@ -1008,6 +1410,7 @@ def macro_foreach(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: Git
         res.append(expr + "\n")
     return "".join(res)
 
+@macro('install')
 def macro_install(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
 
     ver = None
@@ -1062,6 +1465,7 @@ def parse_python_ver(ver: str):
         min = int(m.group(2))
         return maj, min
 
+@macro('use')
 def macro_use(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     ver = None
     arch = None
@@ -1139,25 +1543,22 @@ def macro_use(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubD
 
     return ''
 
+@macro('add_path')
 def macro_add_path(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     #print("add_path args", args)
     for arg in args:
         opts.env_path.append(arg)
     return ''
 
+@macro('clear_path')
 def macro_clear_path(name, args, kwargs, ret, opts: Opts, ctx: Ctx, githubdata: GithubData):
     opts.clear_path = True
     return ''
 
+registry.deprecate('github_rmdir', 'rm', 'move_file', 'copy_file', 'copy_dir', 'untar', 'clean_dir', 'clean_file')
+
 def maybe_macro(line):
-    if '(' not in line:
-        return False
-    if ')' not in line:
-        return False
-    for n in MACRO_NAMES + DEPRECATED_MACRO_NAMES:
-        if n in line:
-            return True
-    return False
+    return registry.maybe_macro(line)
     
 def rewrap(lines):
     text = "".join(lines)
@@ -1170,43 +1571,185 @@ def reindent(expr, orig):
     #print(expr, lines)
     return "\n".join(lines) + "\n"
 
-def expand_macros(name, lines, opts: Opts, github: bool = False, githubdata: GithubData = None):
+MACRO_CACHE_SIZE = 100000
+
+# line -> parsed macro or None, process-wide (compile_many() and repeated compiles reuse it),
+# parsed args and kwargs are shared and must not be modified by macros
+macro_cache = dict()
+
+def parse_macros(lines):
+    res = []
+    with profiler.phase('parse_macros'):
+        for line in lines:
+            macro = None
+            if maybe_macro(line):
+                profiler.count('macro_attempts')
+                if line in macro_cache:
+                    profiler.count('macro_cache_hits')
+                    macro = macro_cache[line]
+                else:
+                    try:
+                        with profiler.phase('lark'):
+                            macro = parse_macro(line)
+                        profiler.count('macro_parsed')
+                    except ParseMacroError as e:
+                        pass
+                    if len(macro_cache) >= MACRO_CACHE_SIZE:
+                        macro_cache.clear()
+                    macro_cache[line] = macro
+            res.append(macro)
+    profiler.count('macro_lines', len(lines))
+    return res
+
+def function_macros(function: Function):
+    # parsed once and shared by local and github renderers
+    if function._macros is None:
+        function._macros = parse_macros(function._body)
+    return function._macros
+
+class MacroError(Exception):
+    pass
+
+def expand_macros(name, lines, opts: Opts, github: bool = False, githubdata: GithubData = None, macros = None, origins = None, prefetch = None):
     res = list(lines)
     shell = 'cmd'
     if githubdata is None:
         githubdata = GithubData()
+    if macros is None:
+        macros = parse_macros(lines)
+    # github step starts in workspace, pushd_cd() also goes there
+    dirs = [True]
     for i, line in enumerate(lines):
-        if maybe_macro(line):
-            try:
-                ret, macroname, args, kwargs = parse_macro(line)
-                if macroname in DEPRECATED_MACRO_NAMES:
-                    print("{} is deprecated".format(macroname))
-                    continue
-                ctx = Ctx(github, shell)
-                exp = globals()['macro_' + macroname](name, args, kwargs, ret, opts, ctx, githubdata)
-                res[i] = reindent(exp, line)
-                continue
-            except ParseMacroError as e:
-                pass
+        if macros[i] is None:
+            if DIR_RX.match(line):
+                dirs = [False]
+            continue
+        ret, macroname, args, kwargs = macros[i]
+        if registry.get(macroname).deprecated:
+            print("{} is deprecated".format(macroname))
+            continue
+        if macroname == 'pushd_cd':
+            dirs.append(True)
+        elif macroname == 'popd_cd':
+            dirs = dirs[:-1] if len(dirs) > 1 else [False]
+        ctx = Ctx(github, shell)
+        ctx.workspace = dirs[-1]
+        if prefetch is not None:
+            ctx.prefetch = prefetch.get(i)
+        try:
+            with profiler.phase('expand_macros'):
+                exp = registry.call(macroname, name, args, kwargs, ret, opts, ctx, githubdata)
+        except Exception as e:
+            if origins is None or origins[i] is None:
+                raise
+            path, lineno = origins[i]
+            raise MacroError("{}:{}: {}".format(path, lineno, e)) from e
+        res[i] = reindent(exp, line)
     return res
 
+def create_temp(path):
+    """
+    Creates temp file next to path, file mode is 0o666 minus process umask (applied by os.open) as for new file
+    """
+    dirname, basename = os.path.split(path)
+    while True:
+        tmp = os.path.join(dirname, '.{}.{}.tmp'.format(basename, os.urandom(4).hex()))
+        try:
+            return os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), tmp
+        except FileExistsError:
+            pass
+
+def write_if_changed(path, text, encoding):
+    """
+    Writes text (newlines are translated as in text mode) unless file has same content (size is compared first),
+    new content is written to temp file in same directory and renamed over path, mode of existing file is kept.
+    Returns True if file was written
+    """
+    data = text.replace('\n', os.linesep).encode(encoding)
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is not None and st.st_size == len(data):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    fd, tmp = create_temp(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if st is not None:
+            os.chmod(tmp, st.st_mode & 0o7777)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
 def write(path, text):
+    """
+    Returns True if file was written
+    """
     if isinstance(path, str):
-        with open(path, 'w', encoding='cp866') as f:
-            f.write(text)
+        return write_if_changed(path, text, 'cp866')
     else:
         # StringIO
         path.write(text)
+        return True
 
 used_ids = set()
 
-class Dumper(yaml.Dumper):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # disable resolving on as tag:yaml.org,2002:bool (disable single quoting)
-        cls = self.__class__
-        cls.yaml_implicit_resolvers['o'] = []
+Dumper = None
+
+def make_dumper(base):
+    class Dumper_(base):
+        pass
+    # disable resolving on as tag:yaml.org,2002:bool (disable single quoting),
+    # own copy of resolvers so yaml.Dumper and loaders are not affected
+    Dumper_.yaml_implicit_resolvers = dict(base.yaml_implicit_resolvers)
+    Dumper_.yaml_implicit_resolvers['o'] = []
+    Dumper_.add_representer(folded_str, folded_str_representer)
+    Dumper_.add_representer(literal_str, literal_str_representer)
+    return Dumper_
 
+PRINTABLE_RX = re.compile('[\\x20-\\x7e]*\\Z')
+
+def libyaml_safe(data):
+    """
+    True if libyaml emitter produces same text as pure python one: strings are printable ascii
+    (no double-quoted style, their folding differs), no folded strings (runs of spaces are folded differently),
+    literal strings have no trailing spaces and no trailing empty lines (libyaml ends document with ... after |+)
+    """
+    if isinstance(data, dict):
+        return all(libyaml_safe(key) and libyaml_safe(value) for key, value in data.items())
+    if isinstance(data, list):
+        return all(libyaml_safe(value) for value in data)
+    if isinstance(data, folded_str):
+        return False
+    if isinstance(data, literal_str):
+        if data.endswith('\n\n') or data.strip('\n') == '':
+            return False
+        return all(PRINTABLE_RX.match(line) is not None and not line.endswith(' ') for line in data.split('\n'))
+    if isinstance(data, str):
+        return PRINTABLE_RX.match(data) is not None
+    return True
+
+CDumper = None
+
+def get_dumper(data=None):
+    """
+    Returns libyaml based dumper (much faster) if it is available and data is safe for it, pure python one otherwise
+    """
+    # yaml is imported on first workflow save, scripts without github-workflow never need it
+    global Dumper, CDumper
+    if Dumper is None:
+        import yaml
+        Dumper = make_dumper(yaml.Dumper)
+        if hasattr(yaml, 'CDumper'):
+            CDumper = make_dumper(yaml.CDumper)
+    if CDumper is not None and data is not None and libyaml_safe(data):
+        return CDumper
+    return Dumper
 
 def make_main_step(cmds, name, local):
     if local:
@@ -1243,90 +1786,872 @@ def filter_empty_lines(text):
     return "\n".join([l for l in text.split('\n') if l.strip() != ''])
 
 def insert_matrix_values(text, matrix : GithubMatrix):
-    for key, values in matrix.matrix.items():
-        pattern = '[$][{][{]\\s*' + 'matrix.' + key + '\\s*[}][}]'
-        text = re.sub(pattern, values[0], text)
-    include = matrix.include
-    if len(include) > 0:
-        for key, value in include[0].items():
-            pattern = '[$][{][{]\\s*' + 'matrix.' + key + '\\s*[}][}]'
-            text = re.sub(pattern, value, text)
-    return text
+    """
+    Returns dict of combination name -> text with ${{ matrix.* }} substituted, one item per combination
+    of matrix (product of values, with exclude and include applied once)
+    """
+    combinations = matrix_.combinations(matrix.matrix, matrix.include, matrix.exclude)
+    names = matrix_.variant_names(combinations)
+    return dict(zip(names, matrix_.render_variants(text, combinations)))
+
+def render_matrix_driver(names, jobs, src_name, warning=True):
+    """
+    Runs script of each matrix combination (script-name.bat next to driver) as separate process, up to jobs at once
+    """
+    res = ['@echo off\n']
+    if warning:
+        res.append('rem This file is generated from {}, all edits will be lost\n'.format(src_name))
+    res.append('if "%~1" equ "pbat_run" goto pbat_run\n')
+    res += render_parallel(names, {name: [] for name in names}, jobs, None, True)
+    return "".join(res)
 
 def github_check_cd(text):
     problem = '%~dp0'
     if problem in text:
         raise Exception("{} does not work on github actions use %CD%".format(problem))
 
-def read_compile_write(src, dst_bat, dst_workflow, verbose=True, echo_off=True, warning=True):
-
-    if isinstance(src, str):
-        src_name = os.path.basename(src)
-    else:
-        src_name = 'untitled'
+def render_steps(script: Script, names, opts: Opts, githubdata: GithubData):
+    steps = []
+    for name in names:
+        function = script.function(name)
+        text = filter_empty_lines(render_function(function, opts, githubdata))
+        text = dedent(text)
+        github_check_cd(text)
+        if text == '':
+            continue
+        shell = 'cmd'
+        condition = None
+        step = GithubShellStep(text, shell, name, condition)
+        steps.append(make_github_step(step, opts, githubdata))
+    return steps
 
-    dst_paths = []
+def make_pre_steps(githubdata: GithubData, opts: Opts):
+    steps = []
+    if githubdata.checkout:
+        steps.append(make_checkout_step())
 
-    # local
-    script = parse_script(src, github=False)
-    opts = script._opts
-    text, files = render_local_main(script, opts, src_name, echo_off, warning)
-    text = dedent(text)
-    write(dst_bat, text)
-    dst_paths.append(dst_bat)
+    if githubdata.setup_msys2:
+        steps.append(make_setup_msys2_step(githubdata.setup_msys2, opts))
 
-    if opts.github_workflow:
-        script = parse_script(src, github=True)
-        opts = script._opts
-        steps1 = []
-        steps2 = []
-        steps3 = []
-        opts = script._opts
-        githubdata = GithubData()
-        keys, thens_ = script.compute_order()
-        for name in keys:
-            function = script.function(name)
-            text = filter_empty_lines(render_function(function, opts, githubdata))
-            text = dedent(text)
-            github_check_cd(text)
-            if text == '':
-                continue
-            shell = 'cmd'
-            condition = None
-            step = GithubShellStep(text, shell, name, condition)
-            steps2.append(make_github_step(step, opts, githubdata))
+    if githubdata.setup_node:
+        steps.append(make_setup_node_step(githubdata.setup_node))
 
-        # pre steps
-        if githubdata.checkout:
-            steps1.append(make_checkout_step())
+    if githubdata.setup_java:
+        steps.append(make_setup_java_step(githubdata.setup_java))
 
-        if githubdata.setup_msys2:
-            steps1.append(make_setup_msys2_step(githubdata.setup_msys2, opts))
+    for item in githubdata.cache:
+        steps.append(make_cache_step(item))
+    return steps
 
-        if githubdata.setup_node:
-            steps1.append(make_setup_node_step(githubdata.setup_node))
+def make_downloads_cache_steps(githubdata: GithubData):
+    """
+    One actions/cache step for all download(..., :cache) destinations, so `:cache` skips curl on github too.
+    Key is derived from urls and destinations, changing any of them starts new cache,
+    matrix values used in them are appended to key so each matrix job has its own cache.
+    """
+    cached = set(path for item in githubdata.cache for path in item.path)
+    downloads = dict()
+    for item in githubdata.downloads:
+        if item.dest not in cached:
+            downloads[item.dest] = item.url
+    if len(downloads) == 0:
+        return []
+    paths = sorted(downloads.keys())
+    text = "\n".join("{} {}".format(downloads[path], path) for path in paths)
+    key = "downloads-" + hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    for ref in sorted(set(matrix_.MATRIX_RX.findall(text))):
+        key += "-${{{{ matrix.{} }}}}".format(ref)
+    return [make_cache_step(GithubCacheStep("cache downloads", paths, key))]
+
+def make_post_steps(githubdata: GithubData, opts: Opts):
+    steps = []
+    if opts.timing:
+        steps.append(make_timing_summary_step())
+        steps.append(make_timing_upload_step())
+    for item in githubdata.upload:
+        steps.append(make_upload_step(item))
+
+    if len(githubdata.release) > 0:
+        steps.append(make_release_step(githubdata.release))
+    return steps
+
+def split_jobs(keys, preds):
+    """
+    Maps def graph onto jobs: chains of defs (def with single predecessor that has no other successors)
+    share a job, everything else starts new job.
+    Returns list of (names, needs) where needs are indexes of jobs
+    """
+    succ = defaultdict(int)
+    for name in keys:
+        for p in preds[name]:
+            succ[p] += 1
+    jobs = []
+    job_of = dict()
+    for name in keys:
+        p = preds[name]
+        if len(p) == 1 and succ[p[0]] == 1 and jobs[job_of[p[0]]][0][-1] == p[0]:
+            job_of[name] = job_of[p[0]]
+            jobs[job_of[name]][0].append(name)
+            continue
+        job_of[name] = len(jobs)
+        jobs.append(([name], []))
+    for name in keys:
+        ix = job_of[name]
+        for p in preds[name]:
+            if job_of[p] != ix and job_of[p] not in jobs[ix][1]:
+                jobs[ix][1].append(job_of[p])
+    return jobs
+
+def merge_githubdata(items):
+    res = GithubData()
+    for item in items:
+        res.checkout = res.checkout or item.checkout
+        res.release.extend(item.release)
+        res.upload.extend(item.upload)
+        res.matrix.matrix.update(item.matrix.matrix)
+        res.matrix.include.extend(item.matrix.include)
+        res.matrix.exclude.extend(item.matrix.exclude)
+        for attr in ['setup_msys2', 'setup_node', 'setup_java']:
+            if getattr(res, attr) is None:
+                setattr(res, attr, getattr(item, attr))
+        res.steps.extend(item.steps)
+        res.cache.extend(item.cache)
+        res.downloads.extend(item.downloads)
+    return res
 
-        if githubdata.setup_java:
-            steps1.append(make_setup_java_step(githubdata.setup_java))
+def job_id(name):
+    name = re.sub('[^0-9a-zA-Z_-]', '_', name)
+    if not re.match('[a-zA-Z_]', name):
+        name = '_' + name
+    return name
+
+def artifact_dir(paths):
+    # upload-artifact strips least common ancestor of paths, download puts files back there
+    dirs = []
+    for path in paths:
+        path = path.replace('\\', '/')
+        if '*' in path:
+            path = path[:path.index('*')]
+            dirs.append(path[:path.rfind('/') + 1].rstrip('/'))
+        else:
+            dirs.append(os.path.dirname(path))
+    if '' in dirs:
+        return '.'
+    common = os.path.commonpath(dirs)
+    if common == '':
+        return '.'
+    return common
+
+def make_download_step(data: GithubUpload):
+    return {
+        "name": "download {}".format(data.name),
+        "uses": "actions/download-artifact@v4",
+        "with": {
+            "name": data.name,
+            "path": artifact_dir(data.path)
+        }
+    }
 
-        for item in githubdata.cache:
-            steps1.append(make_cache_step(item))
+def render_jobs(script: Script, jobs, opts: Opts):
+    """
+    Renders each job with its own GithubData, setup, checkout and cache steps are replicated into every job,
+    artifacts uploaded by github_upload() are downloaded in every job that depends on uploading job.
+    Jobs without steps are dropped and their needs are passed to dependent jobs.
+    Returns dict job id -> job and merged GithubData
+    """
+    datas = []
+    steps = []
+    for names, _ in jobs:
+        githubdata = GithubData()
+        steps.append(render_steps(script, names, opts, githubdata))
+        datas.append(githubdata)
+    githubdata = merge_githubdata(datas)
+
+    needs = []
+    ancestors = []
+    for ix, (names, needs_) in enumerate(jobs):
+        needs_ix = []
+        ancestors_ix = []
+        for n in needs_:
+            if len(steps[n]) == 0 and len(datas[n].upload) == 0 and len(datas[n].release) == 0:
+                needs_ix.extend(needs[n])
+            else:
+                needs_ix.append(n)
+            ancestors_ix.extend(ancestors[n] + [n])
+        needs.append(list(dict.fromkeys(needs_ix)))
+        ancestors.append(list(dict.fromkeys(ancestors_ix)))
+
+    res = dict()
+    ids = dict()
+    for ix, (names, _) in enumerate(jobs):
+        data = datas[ix]
+        if len(steps[ix]) == 0 and len(data.upload) == 0 and len(data.release) == 0:
+            continue
+        ids[ix] = job_id(names[0])
+        downloads = [make_download_step(item) for n in ancestors[ix] for item in datas[n].upload]
+        job = dict()
+        if len(needs[ix]) > 0:
+            job["needs"] = [ids[n] for n in needs[ix]]
+        pre = make_pre_steps(githubdata, opts) + make_downloads_cache_steps(data)
+        job["steps"] = pre + downloads + steps[ix] + make_post_steps(data, opts)
+        res[ids[ix]] = job
+    return res, githubdata
 
-        # post steps
+@dataclass
+class CompileOutput:
+    bat: str = None
+    workflow: dict = None
+    includes: list[str] = field(default_factory=list)
+    warnings: list[str] = field(default_factory=list)
+    error: str = None
+    variants: dict = field(default_factory=dict)
+
+def variant_path(path, name):
+    base, ext = os.path.splitext(path)
+    return "{}-{}{}".format(base, name, ext)
+
+def render_script(script: Script, src_name, echo_off=True, warning=True):
+    """
+    Returns text of bat file, workflow (dict ready for yaml dump, None if github-workflow is off)
+    and dict of matrix combination name -> text of bat file (empty unless local-matrix is on),
+    with local-matrix text of bat file is driver that runs combinations
+    """
+    # script is parsed once, macros and order are shared by local and github renderers
+    order = script.compute_order()
+
+    # local renderer collects env_path and other state into opts, github renderer needs clean opts
+    opts = copy_opts(script._opts)
+    githubdata = GithubData()
+    with profiler.phase('render_local'):
+        text, files = render_local_main(script, opts, src_name, echo_off, warning, order, githubdata)
+        text = dedent(text)
+
+    variants = dict()
+    matrix = githubdata.matrix
+    if opts.local_matrix and (len(matrix.matrix) > 0 or len(matrix.include) > 0):
+        with profiler.phase('render_matrix'):
+            variants = insert_matrix_values(text, matrix)
+            text = render_matrix_driver(list(variants), opts.local_matrix, src_name, warning)
+
+    workflow = None
+    opts = script._opts
+    if opts.github_workflow:
+        script._opts.github = True
+        keys, thens_ = order
+        jobs = None
+        if opts.github_jobs:
+            jobs = split_jobs(keys, script.predecessors(keys))
+        if jobs is None or len(jobs) < 2:
+            githubdata = GithubData()
+            with profiler.phase('render_github'):
+                steps = render_steps(script, keys, opts, githubdata)
+            pre = make_pre_steps(githubdata, opts) + make_downloads_cache_steps(githubdata)
+            steps = pre + steps + make_post_steps(githubdata, opts)
+            workflow = make_workflow(steps, script._opts, githubdata)
+        else:
+            with profiler.phase('render_github'):
+                jobs, githubdata = render_jobs(script, jobs, opts)
+            workflow = make_workflow(None, script._opts, githubdata, jobs)
+    return text, workflow, variants
 
-        for item in githubdata.upload:
-            steps3.append(make_upload_step(item))
+def compile_text(text, resolve=None, name='untitled.pbat', echo_off=True, warning=True) -> CompileOutput:
+    """
+    Compiles source text without touching disk (unless resolve is None and text includes files).
+    resolve(path) returns text of included file or None, path is include name joined with dirname of name.
+    Warnings are collected into output instead of stdout, use yaml_dump() to get workflow text.
+    """
+    import io
+    return compile_captured(text, resolve, name, echo_off, warning, io.StringIO())
+
+def compile_captured(text, resolve, name, echo_off, warning, output):
+    # warnings printed by compiler go to output, they are kept there if compilation fails
+    import contextlib
+    with contextlib.redirect_stdout(output):
+        script = parse_script(name, text=text, load=resolve)
+        bat, workflow, variants = render_script(script, os.path.basename(name), echo_off, warning)
+    return CompileOutput(bat, workflow, script._includes, output.getvalue().splitlines(), variants=variants)
+
+def compile_many(items, resolve=None, echo_off=True, warning=True) -> list[CompileOutput]:
+    """
+    Compiles (name, text) pairs, included files are resolved once for all items,
+    parsed macros are shared via macro_cache. Error in one item is reported in its output.error
+    (with warnings printed before it).
+    """
+    import io
+    load = None
+    if resolve is not None:
+        resolved = dict()
+        def load(path):
+            if path not in resolved:
+                text = resolve(path)
+                resolved[path] = tuple(text.splitlines(True)) if isinstance(text, str) else text
+            return resolved[path]
+    res = []
+    for name, text in items:
+        output = io.StringIO()
+        try:
+            res.append(compile_captured(text, load, name, echo_off, warning, output))
+        except Exception as e:
+            res.append(CompileOutput(warnings=output.getvalue().splitlines(), error=str(e)))
+    return res
 
-        if len(githubdata.release) > 0:
-            steps3.append(make_release_step(githubdata.release))
+def read_compile_write(src, dst_bat, dst_workflow, verbose=True, echo_off=True, warning=True):
 
-        steps = steps1 + steps2 + steps3
+    if isinstance(src, str):
+        src_name = os.path.basename(src)
+    else:
+        src_name = 'untitled'
 
-        save_workflow(dst_workflow, steps, script._opts, githubdata)
+    dst_paths = []
+    changed = []
+
+    script = parse_script(src)
+    includes = script._includes
+    text, workflow, variants = render_script(script, src_name, echo_off, warning)
+
+    with profiler.phase('write'):
+        if write(dst_bat, text):
+            changed.append(dst_bat)
+        dst_paths.append(dst_bat)
+        if isinstance(dst_bat, str):
+            for name, variant in variants.items():
+                path = variant_path(dst_bat, name)
+                if write(path, variant):
+                    changed.append(path)
+                dst_paths.append(path)
+
+    if workflow is not None:
+        if save_workflow(dst_workflow, workflow):
+            changed.append(dst_workflow)
         dst_paths.append(dst_workflow)
 
 
     if verbose and isinstance(src, str) and isinstance(dst_bat, str):
         print("{} -> \n {}".format(src, "\n ".join(dst_paths)))
 
-
+    return CompileResult(dst_paths, includes, changed)
+
+
+
+import unittest
+
+def compiled(text, **kwargs):
+    res = compile_text(textwrap.dedent(text), **kwargs)
+    return res.bat, res.workflow
+
+class TestPrefetch(unittest.TestCase):
+    def test_hoisted(self):
+        bat, _ = compiled("""
+            parallel-downloads 4
+            def main
+                echo start
+                download(https://example.com/a.zip, deps\\a.zip)
+            """)
+        self.assertLess(bat.index('curl --parallel --parallel-max 4 --create-dirs'), bat.index('echo start'))
+
+    def test_not_hoisted_past_set(self):
+        bat, _ = compiled("""
+            parallel-downloads 4
+            def prep
+                set QT_VER=6.5.0
+                mkdir(deps)
+            def main depends on prep
+                download(https://example.com/qt-%QT_VER%.zip, deps\\qt.zip, :cache)
+                download(https://example.com/b.zip)
+            """)
+        self.assertNotIn('--parallel', bat)
+        self.assertLess(bat.index('set QT_VER=6.5.0'), bat.index('mkdir deps'))
+        self.assertLess(bat.index('mkdir deps'), bat.index('qt-%QT_VER%.zip'))
+        self.assertLess(bat.index('qt-%QT_VER%.zip'), bat.index('b.zip'))
+
+    def test_variables(self):
+        bat, _ = compiled("""
+            parallel-downloads 4
+            def main
+                download(https://example.com/a.zip)
+                download(https://example.com/%VER%/b.zip)
+                download(https://example.com/c.zip, %TEMP%\\c.zip)
+            """)
+        self.assertIn('echo url = "https://example.com/a.zip"', bat)
+        self.assertLess(bat.index('--create-dirs'), bat.index('curl -L -o b.zip'))
+        self.assertLess(bat.index('curl -L -o b.zip'), bat.index('curl -L -o "%TEMP%\\c.zip"'))
+
+class TestFetch(unittest.TestCase):
+    SHA = "ab" * 32
+
+    def test_local(self):
+        bat, _ = compiled("""
+            def main
+                download(https://example.com/qt.zip, :sha256={}, :shared)
+                7z x -y qt.zip
+            """.format(self.SHA))
+        call = 'call :pbat_fetch "https://example.com/qt.zip" "qt.zip" "{}_qt.zip" "{}" "" || exit /b 1'.format(self.SHA[:16], self.SHA)
+        self.assertIn(call, bat)
+        self.assertLess(bat.index(call), bat.index('7z x -y qt.zip'))
+        # subroutine is after exit of last def
+        self.assertLess(bat.index('exit /b'), bat.index(':pbat_fetch\n'))
+        for label in [':pbat_fetch_lock', ':pbat_fetch_shared', ':pbat_fetch_direct', ':pbat_fetch_url', ':pbat_sha256']:
+            self.assertIn(label + '\n', bat)
+        self.assertIn('curl -f -L %~4 -o "%~2.part" "%~1" || (', bat)
+        self.assertIn('certutil -hashfile "%~1" SHA256 | findstr /i /x /c:"%~2" > NUL && exit /b 0', bat)
+
+    def test_shared_without_hash(self):
+        bat, _ = compiled("""
+            def main
+                download(https://example.com/qt.zip, :shared, :k)
+            """)
+        self.assertRegex(bat, 'call :pbat_fetch "https://example.com/qt.zip" "qt.zip" "[0-9a-f]{16}_qt.zip" "" "-k" [|][|] exit /b 1')
+
+    def test_no_fetch(self):
+        bat, _ = compiled("""
+            def main
+                download(https://example.com/qt.zip)
+            """)
+        self.assertNotIn(':pbat_fetch', bat)
+
+    def test_bad_hash(self):
+        with self.assertRaises(Exception):
+            compiled("""
+                def main
+                    download(https://example.com/qt.zip, :sha256=abc)
+                """)
+
+    def test_msys2(self):
+        exp = macro_download('download', ['https://example.com/qt.zip'], {'sha256': self.SHA}, None, Opts(), Ctx(False, 'msys2'), GithubData())
+        self.assertIn('echo "{}  qt.zip" | sha256sum -c --quiet - || exit 1\n'.format(self.SHA), exp)
+        with self.assertRaises(MacroError):
+            macro_download('download', ['https://example.com/qt.zip'], {'shared': True}, None, Opts(), Ctx(False, 'msys2'), GithubData())
+
+class TestParallel(unittest.TestCase):
+    SCRIPT = """
+        parallel 2
+        def a
+            echo a
+        def b
+            build b
+        def main depends on a b
+            echo main
+        """
+
+    def test_scheduler(self):
+        bat, _ = compiled(self.SCRIPT)
+        self.assertTrue(bat.startswith('@echo off\n'))
+        self.assertIn('if "%~1" equ "pbat_run" goto pbat_run\n', bat)
+        self.assertIn('set PBAT_JOBS=2\n', bat)
+        self.assertIn('if not exist "%PBAT_RUN%\\a.started" call :pbat_start a\n', bat)
+        self.assertIn('if not exist "%PBAT_RUN%\\main.started" if exist "%PBAT_RUN%\\a.ok" if exist "%PBAT_RUN%\\b.ok" call :pbat_start main\n', bat)
+        self.assertIn('if "%~2" equ "b" call :b_begin\n', bat)
+        self.assertIn('if %PBAT_CODE% neq 0 > "%PBAT_RUN%\\%~2.failed" echo %PBAT_CODE%\n', bat)
+
+    def test_exit_code(self):
+        bat, _ = compiled(self.SCRIPT)
+        # errorlevel of last command reaches pbat_run
+        self.assertIn(':b_begin\nbuild b\nexit /b\n', bat)
+        self.assertNotIn('exit /b 0', bat)
+
+    def test_number_of_processors(self):
+        bat, _ = compiled(self.SCRIPT.replace('parallel 2', 'parallel on'))
+        self.assertIn('set PBAT_JOBS=%NUMBER_OF_PROCESSORS%\n', bat)
+
+    def test_then_exit(self):
+        with self.assertRaises(ValueError):
+            compiled("""
+                parallel on
+                def a then exit
+                    echo a
+                def main depends on a
+                    echo main
+                """)
+
+class TestCheckpoint(unittest.TestCase):
+    SCRIPT = """
+        checkpoint on
+        def a
+            echo a
+        def main depends on a
+            echo main
+        """
+
+    def stamps(self, bat):
+        return re.findall('(?:echo|:pbat_stamp) ((?:a|main) [0-9a-f]{12})$', bat, re.MULTILINE)
+
+    def test_stamp(self):
+        bat, _ = compiled(self.SCRIPT)
+        a, main = self.stamps(bat)
+        self.assertIn(':a_begin\necho a\nif not errorlevel 1 >> "%PBAT_STATE%" echo {}\n'.format(a), bat)
+        self.assertTrue(bat.endswith('if not errorlevel 1 >> "%PBAT_STATE%" echo {}'.format(main)))
+
+    def test_skip(self):
+        bat, _ = compiled(self.SCRIPT)
+        a, main = self.stamps(bat)
+        self.assertIn('findstr /x /c:"{}" "%PBAT_STATE%" > NUL || goto a_begin\n'.format(a), bat)
+        self.assertIn('findstr /x /c:"{}" "%PBAT_STATE%" > NUL || goto main_begin\n'.format(main), bat)
+        self.assertLess(bat.index('goto main_begin'), bat.index('echo all steps are completed'))
+
+    def test_stamp_changes_with_body(self):
+        a1, _ = self.stamps(compiled(self.SCRIPT)[0])
+        a2, _ = self.stamps(compiled(self.SCRIPT.replace('echo a', 'echo b'))[0])
+        self.assertNotEqual(a1, a2)
+
+    def test_parallel_skip(self):
+        bat, _ = compiled(self.SCRIPT + "parallel 2\n")
+        a, main = self.stamps(bat)
+        self.assertIn('findstr /x /c:"{}" "%PBAT_STATE%" > NUL && if exist "%PBAT_RUN%\\a.ok" call :pbat_skip main\n'.format(main), bat)
+        self.assertIn(':pbat_skip\n', bat)
+        # parallel defs append to the same state file, append is retried
+        self.assertIn(':a_begin\necho a\nif not errorlevel 1 call :pbat_stamp {}\nexit /b\n'.format(a), bat)
+        self.assertIn(':pbat_stamp\nset PBAT_TRY=0\n:pbat_stamp_write\n2> NUL (\n    >> "%PBAT_STATE%" echo %~1 %~2\n) && exit /b 0\n', bat)
+        self.assertIn('if %PBAT_TRY% lss 20 goto pbat_stamp_write\n', bat)
+
+class TestYamlDump(unittest.TestCase):
+    def dump(self, data, dumper):
+        import yaml
+        return yaml.dump(data, None, Dumper=dumper, sort_keys=False)
+
+    def setUp(self):
+        get_dumper()
+        if CDumper is None:
+            self.skipTest("libyaml is not available")
+
+    def test_same_output(self):
+        import random
+        rnd = random.Random(1)
+        alphabet = ['word', 'ab', ' ', '  ', '   ', '\\n', '%', ':', '#', '-', '"', "'", '{', '[', '\\\\']
+        def text():
+            return "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 60)))
+        checked = 0
+        for _ in range(3000):
+            value = rnd.choice([str, literal_str, folded_str])(text())
+            data = {"name": text().replace('\\n', ' '), "steps": [{"run": value, "shell": "cmd"}]}
+            if libyaml_safe(data):
+                checked += 1
+                self.assertEqual(self.dump(data, Dumper), self.dump(data, CDumper), repr(data))
+        self.assertGreater(checked, 100)
+
+    def test_workflow(self):
+        _, workflow = compiled("""
+            github-workflow on
+            def main
+                download(https://example.com/a.zip, :cache)
+                echo %PATH%
+                echo done
+            """)
+        self.assertTrue(libyaml_safe(workflow))
+        self.assertEqual(self.dump(workflow, Dumper), self.dump(workflow, CDumper))
+
+    def test_unsafe(self):
+        self.assertFalse(libyaml_safe({"run": folded_str("a  b\n")}))
+        self.assertFalse(libyaml_safe({"run": literal_str("a \nb\n")}))
+        self.assertFalse(libyaml_safe(["\u00e9"]))
+
+class TestDownloadsCache(unittest.TestCase):
+    def cache_steps(self, workflow):
+        steps = [step for job in workflow["jobs"].values() for step in job["steps"]]
+        return [step for step in steps if step["name"] == "cache downloads"]
+
+    def test_step(self):
+        _, workflow = compiled("""
+            github-workflow on
+            def main
+                download(https://example.com/b.zip, :cache)
+                download(https://example.com/a.zip, deps\\a.zip, :cache)
+                download(https://example.com/c.zip)
+                download(https://example.com/d.zip, %TEMP%\\d.zip, :cache)
+            """)
+        steps = workflow["jobs"]["main"]["steps"]
+        self.assertEqual(["cache downloads", "main"], [step["name"] for step in steps])
+        step = steps[0]
+        self.assertEqual("actions/cache@v4", step["uses"])
+        self.assertEqual("b.zip\ndeps\\a.zip\n", step["with"]["path"])
+        self.assertRegex(step["with"]["key"], "^downloads-[0-9a-f]{16}$")
+
+    def test_key(self):
+        script = """
+            github-workflow on
+            def main
+                download(https://example.com/v1/a.zip, :cache)
+            """
+        key1 = self.cache_steps(compiled(script)[1])[0]["with"]["key"]
+        self.assertEqual(key1, self.cache_steps(compiled(script)[1])[0]["with"]["key"])
+        key2 = self.cache_steps(compiled(script.replace('v1', 'v2'))[1])[0]["with"]["key"]
+        self.assertNotEqual(key1, key2)
+
+    def test_matrix(self):
+        _, workflow = compiled("""
+            github-workflow on
+            def main
+                qt = github_matrix([5.15.2, 6.5.0])
+                arch = github_matrix([win64, win32])
+                download(https://example.com/qt-${{ matrix.qt }}-${{ matrix.arch }}.zip, qt.zip, :cache)
+            """)
+        key = self.cache_steps(workflow)[0]["with"]["key"]
+        self.assertRegex(key, "^downloads-[0-9a-f]{16}-[$][{][{] matrix.arch [}][}]-[$][{][{] matrix.qt [}][}]$")
+
+    def test_not_cached(self):
+        _, workflow = compiled("""
+            github-workflow on
+            def main
+                github_cache(deps, :k=deps)
+                download(https://example.com/a.zip, deps, :cache)
+                download(https://example.com/b.zip)
+            """)
+        self.assertEqual([], self.cache_steps(workflow))
+
+    def test_jobs(self):
+        _, workflow = compiled("""
+            github-workflow on
+            github-jobs on
+            def a
+                download(https://example.com/a.zip, :cache)
+            def b
+                echo b
+            def main depends on a b
+                echo main
+            """)
+        self.assertEqual(1, len(self.cache_steps(workflow)))
+        self.assertEqual("a.zip", self.cache_steps(workflow)[0]["with"]["path"])
+
+class TestTiming(unittest.TestCase):
+    SCRIPT = """
+        timing on
+        github-workflow on
+        def build
+            cmake --build .
+        def main depends on build
+            echo main
+        """
+
+    def test_local(self):
+        bat, _ = compiled(self.SCRIPT)
+        self.assertIn('if not defined PBAT_TIMING set PBAT_TIMING=%~dpn0.timing.jsonl\n', bat)
+        self.assertIn(TIMING_BEGIN + 'cmake --build .\ncall :pbat_timing_end build %ERRORLEVEL%\n' + TIMING_BEGIN + 'echo main\n', bat)
+        self.assertIn('call :pbat_timing_end main %ERRORLEVEL%\n', bat)
+        self.assertIn(':pbat_timing_end\nset PBAT_DEF=%~1\nset PBAT_CODE=%~2\n' + TIMING_END, bat)
+        self.assertIn('2> NUL (\n    ' + TIMING_RECORD + ') && exit /b %PBAT_CODE%\n', bat)
+        self.assertIn('if %PBAT_TRY% lss 20 goto pbat_timing_write\n', bat)
+
+    def test_record(self):
+        self.assertTrue(TIMING_BEGIN.startswith('set "PBAT_BEGIN_TIME='))
+        self.assertIn('"seconds": %PBAT_SEC%, "code": %PBAT_CODE%}', TIMING_RECORD)
+        self.assertTrue(TIMING_RECORD.startswith('>> "%PBAT_TIMING%" echo {"def": "%PBAT_DEF%"'))
+        # percent in set /a is doubled, subroutine runs in script body
+        self.assertIn('PBAT_CS=100+PBAT_CS%%100', TIMING_END)
+
+    def test_github(self):
+        _, workflow = compiled(self.SCRIPT)
+        steps = workflow["jobs"]["main"]["steps"]
+        self.assertEqual(["build", "main", "timing", "upload timing"], [step["name"] for step in steps])
+        run = steps[0]["run"]
+        self.assertTrue(run.startswith(TIMING_BEGIN))
+        self.assertIn('set PBAT_TIMING=%RUNNER_TEMP%\\pbat_timing.jsonl\n' + TIMING_END + TIMING_RECORD, run)
+        self.assertTrue(run.endswith('exit /b %PBAT_CODE%\n'))
+        self.assertEqual("always()", steps[2]["if"])
+        upload = steps[3]
+        self.assertEqual("always()", upload["if"])
+        self.assertEqual("actions/upload-artifact@v4", upload["uses"])
+        self.assertEqual("${{ runner.temp }}\\pbat_timing.jsonl", upload["with"]["path"])
+
+class TestWrite(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_unchanged(self):
+        path = self.path('a.bat')
+        self.assertTrue(write_if_changed(path, 'echo a\n', 'cp866'))
+        os.utime(path, ns=(1000000000, 1000000000))
+        self.assertFalse(write_if_changed(path, 'echo a\n', 'cp866'))
+        self.assertEqual(1000000000, os.stat(path).st_mtime_ns)
+
+    def test_changed(self):
+        path = self.path('a.bat')
+        write_if_changed(path, 'echo a\n', 'cp866')
+        os.chmod(path, 0o640)
+        inode = os.stat(path).st_ino
+        self.assertTrue(write_if_changed(path, 'echo b\n', 'cp866'))
+        with open(path, encoding='cp866') as f:
+            self.assertEqual('echo b\n', f.read())
+        st = os.stat(path)
+        # replaced by rename, not rewritten in place
+        self.assertNotEqual(inode, st.st_ino)
+        if os.name != 'nt':
+            self.assertEqual(0o640, st.st_mode & 0o777)
+        self.assertEqual(['a.bat'], os.listdir(self.dir))
+
+    def test_same_size(self):
+        path = self.path('a.yml')
+        write_if_changed(path, 'a: 1\n', 'utf-8')
+        self.assertTrue(write_if_changed(path, 'a: 2\n', 'utf-8'))
+
+    def test_compile_result(self):
+        src = self.path('a.pbat')
+        with open(src, 'w', encoding='utf-8') as f:
+            f.write('github-workflow on\ndef main\n    echo a\n')
+        dst_bat = self.path('a.bat')
+        dst_workflow = os.path.join(self.dir, '.github', 'workflows', 'a.yml')
+        result = read_compile_write(src, dst_bat, dst_workflow, verbose=False)
+        self.assertEqual([dst_bat, dst_workflow], result.changed)
+        result = read_compile_write(src, dst_bat, dst_workflow, verbose=False)
+        self.assertEqual([dst_bat, dst_workflow], result.dst_paths)
+        self.assertEqual([], result.changed)
+
+class TestJobs(unittest.TestCase):
+    SCRIPT = """
+        github-workflow on
+        github-jobs on
+        def setup
+            github_checkout()
+            v = github_matrix([1, 2])
+            echo setup
+        def lib depends on setup
+            echo lib
+            github_upload(build\\lib\\lib.dll, build\\lib\\lib.lib, :n=lib)
+        def app depends on setup
+            echo app
+        def main depends on lib app
+            echo main
+        """
+
+    def test_split(self):
+        keys = ['setup', 'lib', 'app', 'main']
+        preds = {'setup': [], 'lib': ['setup'], 'app': ['setup'], 'main': ['lib', 'app']}
+        self.assertEqual([(['setup'], []), (['lib'], [0]), (['app'], [0]), (['main'], [1, 2])], split_jobs(keys, preds))
+
+    def test_split_chain(self):
+        keys = ['a', 'b', 'c', 'd']
+        preds = {'a': [], 'b': ['a'], 'c': ['b'], 'd': []}
+        self.assertEqual([(['a', 'b', 'c'], []), (['d'], [])], split_jobs(keys, preds))
+
+    def test_needs(self):
+        _, workflow = compiled(self.SCRIPT)
+        jobs = workflow["jobs"]
+        self.assertEqual(['setup', 'lib', 'app', 'main'], list(jobs))
+        self.assertNotIn("needs", jobs["setup"])
+        self.assertEqual(['setup'], jobs["lib"]["needs"])
+        self.assertEqual(['setup'], jobs["app"]["needs"])
+        self.assertEqual(['lib', 'app'], jobs["main"]["needs"])
+        for job in jobs.values():
+            # setup steps and matrix are replicated, not shared by yaml anchors
+            self.assertEqual("checkout", job["steps"][0]["name"])
+            self.assertEqual({"v": ["1", "2"]}, {k: v for k, v in job["strategy"]["matrix"].items()})
+        self.assertIsNot(jobs["lib"]["strategy"], jobs["app"]["strategy"])
+        self.assertNotIn('&id', yaml_dump(workflow))
+
+    def test_artifacts(self):
+        _, workflow = compiled(self.SCRIPT)
+        jobs = workflow["jobs"]
+        upload = jobs["lib"]["steps"][-1]
+        self.assertEqual("actions/upload-artifact@v4", upload["uses"])
+        self.assertEqual("lib", upload["with"]["name"])
+        download = jobs["main"]["steps"][1]
+        self.assertEqual({"name": "download lib", "uses": "actions/download-artifact@v4", "with": {"name": "lib", "path": "build/lib"}}, download)
+        for name in ["setup", "lib", "app"]:
+            self.assertNotIn("download lib", [step["name"] for step in jobs[name]["steps"]])
+
+    def test_empty_job(self):
+        # b renders no steps, its job is dropped and c, d need its needs
+        _, workflow = compiled("""
+            github-workflow on
+            github-jobs on
+            def x
+                echo x
+            def y
+                echo y
+            def b depends on x y
+                v = github_matrix([1])
+            def c depends on b
+                echo c
+            def d depends on b
+                echo d
+            def main depends on c d
+                echo main
+            """)
+        jobs = workflow["jobs"]
+        self.assertEqual(['x', 'y', 'c', 'd', 'main'], list(jobs))
+        self.assertEqual(['x', 'y'], jobs["c"]["needs"])
+        self.assertEqual(['x', 'y'], jobs["d"]["needs"])
+        self.assertEqual(['c', 'd'], jobs["main"]["needs"])
+
+    def test_single_chain(self):
+        _, workflow = compiled("""
+            github-workflow on
+            github-jobs on
+            def a
+                echo a
+            def main depends on a
+                echo main
+            """)
+        self.assertEqual(["main"], list(workflow["jobs"]))
+        self.assertEqual(["a", "main"], [step["name"] for step in workflow["jobs"]["main"]["steps"]])
+
+    def test_merge(self):
+        a = GithubData()
+        a.upload.append(GithubUpload("a", ["a.zip"]))
+        a.matrix.matrix["v"] = ["1"]
+        b = GithubData()
+        b.checkout = True
+        b.upload.append(GithubUpload("b", ["b.zip"]))
+        res = merge_githubdata([a, b])
+        self.assertTrue(res.checkout)
+        self.assertEqual(["a", "b"], [item.name for item in res.upload])
+        self.assertEqual({"v": ["1"]}, res.matrix.matrix)
+
+    def test_artifact_dir(self):
+        self.assertEqual("build/lib", artifact_dir(["build\\lib\\a.dll", "build\\lib\\b.dll"]))
+        self.assertEqual("build", artifact_dir(["build\\lib\\a.dll", "build\\bin\\b.exe"]))
+        self.assertEqual(".", artifact_dir(["a.zip", "build\\b.zip"]))
+        self.assertEqual("dist", artifact_dir(["dist\\*.whl"]))
+
+class TestCompileText(unittest.TestCase):
+    def test_compile_text(self):
+        res = compile_text("def main\n    echo main\n", name='dir/a.pbat')
+        self.assertIn('rem This file is generated from a.pbat', res.bat)
+        self.assertIn('echo main', res.bat)
+        self.assertIsNone(res.workflow)
+        self.assertEqual([], res.warnings)
+
+    def test_warnings(self):
+        res = compile_text("def foo\n    echo foo\ndef main\n    echo main\n")
+        self.assertEqual(["warning: not reachable foo"], res.warnings)
+
+    def test_resolve(self):
+        files = {os.path.join('dir', 'common.pbat'): 'def common\n    echo common\n'}
+        res = compile_text("include(common)\ndef main depends on common\n    echo main\n", files.get, name=os.path.join('dir', 'a.pbat'))
+        self.assertLess(res.bat.index('echo common'), res.bat.index('echo main'))
+        self.assertEqual([os.path.join('dir', 'common.pbat')], res.includes)
+
+    def test_workflow(self):
+        res = compile_text("github-workflow on\ndef main\n    echo main\n")
+        self.assertEqual("echo main", res.workflow["jobs"]["main"]["steps"][0]["run"])
+
+    def test_compile_many(self):
+        calls = []
+        def resolve(path):
+            calls.append(path)
+            return 'def common\n    echo common\n'
+        items = [
+            ('a.pbat', "include(common)\ndef main depends on common\n    echo a\n"),
+            ('b.pbat', "include(common)\ndef unused\n    echo unused\ndef main depends on common\n    echo b\n"),
+            ('c.pbat', "def foo\n    echo foo\ndef main depends on missing\n    echo c\n"),
+        ]
+        a, b, c = compile_many(items, resolve)
+        self.assertEqual(['common.pbat'], calls)
+        self.assertIn('echo a', a.bat)
+        self.assertEqual(["warning: not reachable unused"], b.warnings)
+        self.assertIsNone(c.bat)
+        self.assertIn('depends on undefined missing', c.error)
+
+    def test_compile_many_error_warnings(self):
+        res, = compile_many([('a.pbat', "def foo\n    echo foo\ndef main\n    download()\n")])
+        self.assertIsNotNone(res.error)
+        self.assertEqual(["warning: not reachable foo"], res.warnings)
+
+if __name__ == "__main__":
+    unittest.main()
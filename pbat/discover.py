@@ -0,0 +1,142 @@
+import os
+
+IGNORE_FILE = '.pbatignore'
+
+def read_ignore(path):
+    p = os.path.join(path, IGNORE_FILE)
+    if not os.path.isfile(p):
+        return []
+    with open(p, encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line != '' and not line.startswith('#')]
+
+def is_ignored(path, is_dir, ignores):
+    from fnmatch import fnmatch
+    name = os.path.basename(path)
+    for base, patterns in ignores:
+        rel = os.path.relpath(path, base).replace(os.sep, '/')
+        for pat in patterns:
+            if pat.endswith('/'):
+                if not is_dir:
+                    continue
+                pat = pat[:-1]
+            if fnmatch(rel, pat) or fnmatch(name, pat):
+                return True
+    return False
+
+def find_pbats(path, recursive=False, ignores=None):
+    ignores = list(ignores or [])
+    patterns = read_ignore(path)
+    if len(patterns) > 0:
+        ignores.append((path, patterns))
+    paths = []
+    dirs = []
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir():
+            if recursive and not e.name.startswith('.') and not is_ignored(e.path, True, ignores):
+                dirs.append(e.path)
+            continue
+        if os.path.splitext(e.name)[1] != '.pbat':
+            continue
+        if is_ignored(e.path, False, ignores):
+            continue
+        paths.append(e.path)
+    for d in dirs:
+        paths += find_pbats(d, recursive, ignores)
+    return paths
+
+def find_dirs(path, recursive=False, ignores=None):
+    """
+    Returns path and (if recursive) subdirectories that find_pbats searches
+    """
+    ignores = list(ignores or [])
+    patterns = read_ignore(path)
+    if len(patterns) > 0:
+        ignores.append((path, patterns))
+    dirs = [path]
+    if not recursive:
+        return dirs
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir() and not e.name.startswith('.') and not is_ignored(e.path, True, ignores):
+            dirs += find_dirs(e.path, recursive, ignores)
+    return dirs
+
+def uniq_paths(paths):
+    # overlapping globs and dirs can yield same file under different names
+    res = []
+    seen = set()
+    for path in paths:
+        key = os.path.normcase(os.path.realpath(path))
+        if key in seen:
+            continue
+        seen.add(key)
+        res.append(path)
+    return res
+
+import unittest
+
+class TestFind(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        for name in ['a.pbat', 'b.txt', 'skip.pbat', 'sub/c.pbat', 'sub/gen/d.pbat', 'sub/e.pbat', '.hidden/f.pbat', 'build/g.pbat']:
+            self.write(name, 'def main\n    echo main\n')
+        self.write(IGNORE_FILE, '# comment\n\nskip.pbat\nbuild/\n')
+        self.write('sub/' + IGNORE_FILE, 'gen/\ne.*\n')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def names(self, paths):
+        return [os.path.relpath(path, self.dir).replace(os.sep, '/') for path in paths]
+
+    def test_find(self):
+        self.assertEqual(['a.pbat'], self.names(find_pbats(self.dir)))
+
+    def test_recursive(self):
+        self.assertEqual(['a.pbat', 'sub/c.pbat'], self.names(find_pbats(self.dir, True)))
+
+    def test_dirs(self):
+        self.assertEqual(['.'], self.names(find_dirs(self.dir)))
+        self.assertEqual(['.', 'sub'], self.names(find_dirs(self.dir, True)))
+
+    def test_read_ignore(self):
+        self.assertEqual(['skip.pbat', 'build/'], read_ignore(self.dir))
+        self.assertEqual([], read_ignore(os.path.join(self.dir, 'build')))
+
+    def test_is_ignored(self):
+        ignores = [(self.dir, ['build/', 'sub/*.pbat', '*.tmp'])]
+        self.assertTrue(is_ignored(os.path.join(self.dir, 'build'), True, ignores))
+        # directory pattern does not match files
+        self.assertFalse(is_ignored(os.path.join(self.dir, 'build'), False, ignores))
+        self.assertTrue(is_ignored(os.path.join(self.dir, 'sub', 'c.pbat'), False, ignores))
+        self.assertFalse(is_ignored(os.path.join(self.dir, 'c.pbat'), False, ignores))
+        self.assertTrue(is_ignored(os.path.join(self.dir, 'sub', 'x.tmp'), False, ignores))
+
+    def test_uniq_paths(self):
+        a = os.path.join(self.dir, 'a.pbat')
+        other = os.path.join(self.dir, 'sub', '..', 'a.pbat')
+        paths = [a, other, os.path.join(self.dir, 'sub', 'c.pbat')]
+        if hasattr(os, 'symlink'):
+            link = os.path.join(self.dir, 'link.pbat')
+            try:
+                os.symlink(a, link)
+                paths.append(link)
+            except OSError:
+                pass
+        self.assertEqual([a, os.path.join(self.dir, 'sub', 'c.pbat')], uniq_paths(paths))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import re
+from collections import Counter, defaultdict
+
+GOTO_RX = re.compile('goto\\s*([0-9a-z_]+)', re.IGNORECASE)
+CALL_RX = re.compile('call\\s*:([0-9a-z_]+)', re.IGNORECASE)
+LABEL_RX = re.compile('^:([0-9a-z_]+)', re.IGNORECASE)
+JUMP_RX = re.compile('goto ([0-9a-z_]+)', re.IGNORECASE)
+
+EXIT = "exit /b\n"
+
+def remove_unused_labels(res):
+    changed = False
+    gotos = []
+    for line in res:
+        for m in GOTO_RX.findall(line):
+            gotos.append(m)
+        for m in CALL_RX.findall(line):
+            gotos.append(m)
+
+    for i, line in enumerate(res):
+        m = LABEL_RX.match(line)
+        if m:
+            if m.group(1) not in gotos:
+                res[i] = ""
+                changed = True
+    return changed
+
+def remove_redundant_gotos(res):
+    changed = False
+    ixs = [i for i, line in enumerate(res) if JUMP_RX.match(line)]
+    for i in ixs:
+        goto = JUMP_RX.match(res[i]).group(1)
+        if goto == 'end':
+            res[i] = EXIT
+            changed = True
+            continue
+        for j in range(i+1, len(res)):
+            line = res[j]
+            if line.strip() == "":
+                continue
+            m = LABEL_RX.match(line)
+            if m:
+                label = m.group(1)
+                if label == goto:
+                    res[i] = ""
+                    changed = True
+            break
+
+    # trim extra exits at the end of the file
+    for i in reversed(range(len(res))):
+        line = res[i].strip()
+        if line == "exit /b":
+            res[i] = ""
+            changed = True
+        elif line == "":
+            pass
+        else:
+            break
+
+    return changed
+
+def optimize_slow(res):
+    """
+    Reference implementation: applies both passes until nothing changes
+    """
+    while(True):
+        ok1 = remove_unused_labels(res)
+        ok2 = remove_redundant_gotos(res)
+        if not ok1 and not ok2:
+            break
+
+def optimize(res):
+    """
+    Removes unused labels, gotos to the next label, `goto end` and trailing exits in place.
+    Same result as optimize_slow in linear time: every chunk of res is classified once,
+    labels are indexed by name with reference counts, non-blank chunks are kept in a linked list,
+    and removal of a chunk only rechecks its neighbours and labels it referenced.
+    """
+    n = len(res)
+    refs = [None] * n
+    jumps = [None] * n
+    labels = [None] * n
+    counts = Counter()
+    by_name = defaultdict(list)
+    prev = [None] * n
+    next_ = [None] * n
+    last = None
+
+    for i, line in enumerate(res):
+        if line.strip() == "":
+            continue
+        refs[i] = GOTO_RX.findall(line) + CALL_RX.findall(line)
+        counts.update(refs[i])
+        m = LABEL_RX.match(line)
+        if m:
+            labels[i] = m.group(1)
+            by_name[labels[i]].append(i)
+        m = JUMP_RX.match(line)
+        if m:
+            jumps[i] = m.group(1)
+        prev[i] = last
+        if last is not None:
+            next_[last] = i
+        last = i
+
+    work = []
+
+    def unref(i):
+        for name in refs[i]:
+            counts[name] -= 1
+            if counts[name] == 0:
+                work.extend(by_name.get(name, []))
+        refs[i] = []
+
+    def redundant(i):
+        j = next_[i]
+        return jumps[i] is not None and j is not None and labels[j] == jumps[i]
+
+    def clear(i):
+        nonlocal last
+        res[i] = ""
+        unref(i)
+        p, q = prev[i], next_[i]
+        if p is not None:
+            next_[p] = q
+        if q is not None:
+            prev[q] = p
+        else:
+            last = p
+        prev[i] = next_[i] = None
+        labels[i] = jumps[i] = None
+        if p is not None:
+            work.append(p)
+
+    # goto end is exit, it is never a jump again
+    for i in range(n):
+        if jumps[i] == 'end':
+            res[i] = EXIT
+            jumps[i] = None
+            labels[i] = None
+            unref(i)
+
+    work.extend(i for i in range(n) if labels[i] is not None and counts[labels[i]] == 0)
+    work.extend(i for i in range(n) if jumps[i] is not None)
+
+    while True:
+        while len(work) > 0:
+            i = work.pop()
+            if res[i] == "":
+                continue
+            if labels[i] is not None and counts[labels[i]] == 0:
+                clear(i)
+            elif redundant(i):
+                clear(i)
+        if last is not None and res[last].strip() == "exit /b":
+            clear(last)
+            continue
+        break
+
+import unittest
+
+class TestOptimize(unittest.TestCase):
+    def test_chain(self):
+        res = [':main_begin\n', 'echo 1\n', ':main_end\n', 'goto foo_begin\n', '\n', ':foo_begin\n', 'goto end\n', ':foo_end\n', 'exit /b\n', '\n']
+        expected = ['', 'echo 1\n', '', '', '\n', '', '', '', '', '\n']
+        optimize(res)
+        self.assertEqual(expected, res)
+
+    def test_same_as_slow(self):
+        import random
+        rnd = random.Random(1)
+        names = ['a', 'b', 'end']
+        def chunk():
+            name = rnd.choice(names)
+            return rnd.choice([':{}\n', 'goto {}\n', 'call :{}\n', 'exit /b\n', '\n', 'echo {}\n', ':{}\ngoto a\n']).format(name)
+        for _ in range(2000):
+            res = [chunk() for _ in range(rnd.randint(0, 10))]
+            expected = list(res)
+            optimize_slow(expected)
+            optimize(res)
+            self.assertEqual(expected, res)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = '.pbat-manifest.json'
+
+# path -> (mtime_ns, size, hash), long running processes (watch, serve) rehash only changed files
+hash_cache = dict()
+
+def file_hash(path):
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    cached = hash_cache.get(key)
+    if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        hash = hashlib.sha1(f.read()).hexdigest()
+    hash_cache[key] = (st.st_mtime_ns, st.st_size, hash)
+    return hash
+
+class Manifest:
+    """
+    Content hashes of sources, their transitive includes and outputs, one manifest
+    file per directory of sources. Entry is fresh if key (compiler version)
+    is the same, all hashes match and all outputs exist.
+    """
+
+    def __init__(self, key):
+        self._key = key
+        self._dirs = dict()
+        self._changed = set()
+
+    def _entries(self, dirname):
+        if dirname not in self._dirs:
+            entries = dict()
+            path = os.path.join(dirname, MANIFEST_NAME)
+            if os.path.isfile(path):
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        entries = json.load(f).get("files", dict())
+                except ValueError:
+                    pass
+            self._dirs[dirname] = entries
+        return self._dirs[dirname]
+
+    def _split(self, src):
+        dirname = os.path.dirname(src)
+        return (dirname if dirname != '' else '.'), os.path.basename(src)
+
+    def is_fresh(self, src):
+        dirname, name = self._split(src)
+        entry = self._entries(dirname).get(name)
+        if entry is None or entry.get("key") != self._key:
+            return False
+        for path in entry["outputs"]:
+            if not os.path.exists(os.path.join(dirname, path)):
+                return False
+        for path, hash in entry["sources"].items():
+            path = os.path.join(dirname, path)
+            if not os.path.isfile(path) or file_hash(path) != hash:
+                return False
+        return True
+
+    def includes(self, src):
+        dirname, name = self._split(src)
+        entry = self._entries(dirname).get(name)
+        if entry is None:
+            return []
+        res = [os.path.normpath(os.path.join(dirname, path)) for path in entry["sources"]]
+        return [path for path in res if path != os.path.normpath(src)]
+
+    def update(self, src, includes, outputs):
+        dirname, name = self._split(src)
+        sources = dict()
+        for path in [src] + list(includes):
+            if os.path.isfile(path):
+                sources[os.path.relpath(path, dirname)] = file_hash(path)
+        self._entries(dirname)[name] = {
+            "key": self._key,
+            "sources": sources,
+            "outputs": [os.path.relpath(path, dirname) for path in outputs]
+        }
+        self._changed.add(dirname)
+
+    def remove(self, src):
+        dirname, name = self._split(src)
+        entries = self._entries(dirname)
+        if name in entries:
+            del entries[name]
+            self._changed.add(dirname)
+
+    def save(self):
+        for dirname in sorted(self._changed):
+            path = os.path.join(dirname, MANIFEST_NAME)
+            data = {"files": dict(sorted(self._dirs[dirname].items()))}
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+        self._changed = set()
+
+import unittest
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        self.src = self.path('main.pbat', 'include(common)\ndef main\n    echo main\n')
+        self.inc = self.path('common.pbat', 'def common\n    echo common\n')
+        self.out = self.path('main.bat', '')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def path(self, name, text=None):
+        path = os.path.join(self.dir, name)
+        if text is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return path
+
+    def touch(self, path, text):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(text)
+        # size changes, hash cache sees it even within mtime granularity
+        hash_cache.pop(os.path.abspath(path), None)
+
+    def updated(self, key='1'):
+        manifest = Manifest(key)
+        manifest.update(self.src, [self.inc], [self.out])
+        return manifest
+
+    def test_fresh(self):
+        manifest = self.updated()
+        self.assertTrue(manifest.is_fresh(self.src))
+        self.assertEqual([os.path.normpath(self.inc)], manifest.includes(self.src))
+
+    def test_unknown(self):
+        self.assertFalse(Manifest('1').is_fresh(self.src))
+
+    def test_source_changed(self):
+        manifest = self.updated()
+        self.touch(self.src, 'rem\n')
+        self.assertFalse(manifest.is_fresh(self.src))
+
+    def test_include_changed(self):
+        manifest = self.updated()
+        self.touch(self.inc, 'rem\n')
+        self.assertFalse(manifest.is_fresh(self.src))
+
+    def test_output_missing(self):
+        manifest = self.updated()
+        os.unlink(self.out)
+        self.assertFalse(manifest.is_fresh(self.src))
+
+    def test_save_load(self):
+        self.updated().save()
+        self.assertTrue(os.path.isfile(self.path(MANIFEST_NAME)))
+        self.assertTrue(Manifest('1').is_fresh(self.src))
+        # other compiler version
+        self.assertFalse(Manifest('2').is_fresh(self.src))
+
+    def test_remove(self):
+        manifest = self.updated()
+        manifest.save()
+        manifest.remove(self.src)
+        self.assertFalse(manifest.is_fresh(self.src))
+        self.assertEqual([], manifest.includes(self.src))
+        manifest.save()
+        self.assertFalse(Manifest('1').is_fresh(self.src))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import re
+import itertools
+
+MATRIX_RX = re.compile('[$][{][{]\\s*matrix[.]([A-Za-z0-9_-]+)\\s*[}][}]')
+
+def matches(combination, values):
+    return all(combination.get(key) == value for key, value in values.items())
+
+def combinations(matrix, include, exclude):
+    """
+    Expands matrix (key -> list of values) the way github actions does: product of values
+    without combinations matching any of exclude, then each include is merged into combinations
+    where it does not overwrite original matrix values, or appended as new combination
+    """
+    keys = list(matrix.keys())
+    res = []
+    if len(keys) > 0:
+        for values in itertools.product(*[matrix[key] for key in keys]):
+            combination = dict(zip(keys, [str(value) for value in values]))
+            if not any(matches(combination, item) for item in exclude):
+                res.append(combination)
+    originals = [dict(combination) for combination in res]
+    for item in include:
+        item = {key: str(value) for key, value in item.items()}
+        original_values = {key: value for key, value in item.items() if key in matrix}
+        merged = False
+        for combination, original in zip(res, originals):
+            if matches(original, original_values):
+                combination.update(item)
+                merged = True
+        if not merged:
+            res.append(item)
+    return res
+
+def variant_names(combinations):
+    """
+    Returns file name safe unique name for each combination
+    """
+    res = []
+    used = set()
+    for i, combination in enumerate(combinations):
+        name = "-".join([re.sub('[^A-Za-z0-9._]+', '_', value) for value in combination.values()])
+        if name == '' or name in used:
+            name = "{}-{}".format(name, i + 1) if name != '' else str(i + 1)
+        used.add(name)
+        res.append(name)
+    return res
+
+def render_variants(text, combinations):
+    """
+    Substitutes ${{ matrix.key }} for each combination, only lines with references are rendered
+    (unknown keys are replaced with empty string as in github actions)
+    """
+    lines = text.split('\n')
+    positions = [i for i, line in enumerate(lines) if MATRIX_RX.search(line)]
+    res = []
+    for combination in combinations:
+        variant = list(lines)
+        for i in positions:
+            variant[i] = MATRIX_RX.sub(lambda m: combination.get(m.group(1), ''), lines[i])
+        res.append("\n".join(variant))
+    return res
+
+import unittest
+
+class TestMatrix(unittest.TestCase):
+    def test_product(self):
+        res = combinations({"qt": ["5.15", "6.5"], "arch": ["win64", "win32"]}, [], [{"qt": "5.15", "arch": "win32"}])
+        self.assertEqual(res, [
+            {"qt": "5.15", "arch": "win64"},
+            {"qt": "6.5", "arch": "win64"},
+            {"qt": "6.5", "arch": "win32"}
+        ])
+
+    def test_include(self):
+        matrix = {"fruit": ["apple", "pear"], "animal": ["cat", "dog"]}
+        include = [
+            {"color": "green"},
+            {"color": "pink", "animal": "cat"},
+            {"fruit": "apple", "shape": "circle"},
+            {"fruit": "banana"},
+            {"fruit": "banana", "animal": "cat"},
+        ]
+        # example from github actions documentation
+        self.assertEqual(combinations(matrix, include, []), [
+            {"fruit": "apple", "animal": "cat", "color": "pink", "shape": "circle"},
+            {"fruit": "apple", "animal": "dog", "color": "green", "shape": "circle"},
+            {"fruit": "pear", "animal": "cat", "color": "pink"},
+            {"fruit": "pear", "animal": "dog", "color": "green"},
+            {"fruit": "banana"},
+            {"fruit": "banana", "animal": "cat"},
+        ])
+
+    def test_include_only(self):
+        self.assertEqual(combinations({}, [{"os": "a"}, {"os": "b"}], []), [{"os": "a"}, {"os": "b"}])
+
+    def test_names(self):
+        self.assertEqual(variant_names([{"v": "6.5.0", "a": "win 64"}, {"v": "6.5.0", "a": "win 64"}, {}]), ["6.5.0-win_64", "6.5.0-win_64-2", "3"])
+
+    def test_render(self):
+        text = "echo ${{ matrix.qt }}\necho plain\necho ${{matrix.arch}} ${{ matrix.none }}"
+        res = render_variants(text, [{"qt": "5", "arch": "x64"}, {"qt": "6", "arch": "x86"}])
+        self.assertEqual(res, ["echo 5\necho plain\necho x64 ", "echo 6\necho plain\necho x86 "])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,31 +1,101 @@
 import os
-from lark import Lark, Tree, Token
 import unittest
 import re
 
-base = os.path.dirname(__file__)
-path = os.path.join(base, "def.lark")
-with open(path, encoding='utf-8') as f:
-    GRAMMAR = f.read()
+parser = None
 
-parser = Lark(GRAMMAR)
+def get_parser():
+    # only used for headers that fast path rejects
+    global parser
+    if parser is None:
+        from lark import Lark
+        base = os.path.dirname(__file__)
+        path = os.path.join(base, "def.lark")
+        with open(path, encoding='utf-8') as f:
+            grammar = f.read()
+        parser = Lark(grammar)
+    return parser
 
 def find_data(tree, data, trace = False):
     return [child for child in tree.children if hasattr(child, 'data') and child.data == data]
 
 DEF_RX = re.compile('\\s*def\\s+([0-9a-z_]+)', re.IGNORECASE)
 
+KEYWORDS = {'def', 'then', 'depends', 'on', 'shell', 'if', 'and'}
+
+NAME = '[a-zA-Z0-9_-]+'
+ARGS = "[a-zA-Z0-9_'.-]+(?:\\s*[a-zA-Z0-9_'.-]+)*"
+COND = ARGS + '\\s*==\\s*' + ARGS
+# then and if followed by condition end depends list, other keywords are ambiguous there and left to grammar
+NOT_KEYWORD = '(?!then(?:\\s|$))(?!if\\s+' + COND + '\\s*$)'
+
+HEADER_RX = re.compile('\\s*def\\s+(' + NAME + ')')
+CLAUSE_RX = re.compile(
+    '\\s+(then|shell)\\s+(' + NAME + ')'
+    '|\\s+depends\\s+on((?:\\s+' + NOT_KEYWORD + NAME + ')+)'
+    '|\\s+if\\s+(' + COND + ')\\s*$'
+)
+END_RX = re.compile('\\s*$')
+COND_SPLIT_RX = re.compile("[\\s'.=]+")
+
+def parse_def_fast(line):
+    """
+    single pass recognizer for well-formed def headers,
+    returns None if header should be parsed by grammar
+    """
+    m = HEADER_RX.match(line)
+    if m is None:
+        return None
+    name = m.group(1)
+    then = None
+    depends = []
+    shell = None
+    condition = None
+    pos = m.end()
+    while END_RX.match(line, pos) is None:
+        m = CLAUSE_RX.match(line, pos)
+        if m is None:
+            return None
+        keyword, value, names, cond = m.groups()
+        if keyword is not None:
+            if value in KEYWORDS:
+                return None
+            if keyword == 'then':
+                then = value
+            else:
+                shell = value
+        elif names is not None:
+            names = [n for n in names.split() if n != 'and']
+            if KEYWORDS.intersection(names):
+                return None
+            depends += names
+        else:
+            if KEYWORDS.intersection(COND_SPLIT_RX.split(cond)):
+                return None
+            condition = cond
+        pos = m.end()
+    if name in KEYWORDS:
+        return None
+    return name, then, depends, shell, condition
+
 def parse_def(line):
 
     m = DEF_RX.match(line)
     if m is None:
         return None
 
+    res = parse_def_fast(line)
+    if res is not None:
+        return res
+
+    return parse_def_grammar(line)
+
+def parse_def_grammar(line):
     name = None
     then = None
     depends = []
     shell = None
-    tree = parser.parse(line)
+    tree = get_parser().parse(line)
 
     for item in find_data(tree, 'defname'):
         name = item.children[0].value
@@ -48,20 +118,37 @@ def parse_def(line):
 class TestParse(unittest.TestCase):
     def test1(self):
         def_ = 'def baz depends on foo bar then qux shell corge'
-        expected = 'baz', 'qux', ['foo', 'bar'], 'corge'
+        expected = 'baz', 'qux', ['foo', 'bar'], 'corge', None
         self.assertEqual(expected, parse_def(def_))
     def test2(self):
         def_ = 'def third depends on second'
-        expected = 'third', None, ['second'], None
+        expected = 'third', None, ['second'], None, None
         self.assertEqual(expected, parse_def(def_))
     def test3(self):
         def_ = 'def second shell msys2'
-        expected = 'second', None, [], 'msys2'
+        expected = 'second', None, [], 'msys2', None
         self.assertEqual(expected, parse_def(def_))
     def test4(self):
         def_= 'def main then second'
-        expected = 'main', 'second', [], None
+        expected = 'main', 'second', [], None, None
+        self.assertEqual(expected, parse_def(def_))
+    def test5(self):
+        def_ = "def build depends on foo and bar if 'x' == 'y'"
+        expected = 'build', None, ['foo', 'bar'], None, "'x' == 'y'"
         self.assertEqual(expected, parse_def(def_))
+    def test_fast(self):
+        defs = [
+            'def baz depends on foo bar then qux shell corge\n',
+            'def baz then qux depends on foo and bar',
+            "def main depends on foo if a.b == 'c'  ",
+            'def main-1 shell msys2 then second',
+        ]
+        for def_ in defs:
+            self.assertEqual(parse_def_grammar(def_), parse_def_fast(def_))
+    def test_fallback(self):
+        for def_ in ['def main depends on foo shell bar', 'def main if foo == bar then baz']:
+            self.assertIsNone(parse_def_fast(def_))
+            self.assertEqual(parse_def_grammar(def_), parse_def(def_))
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
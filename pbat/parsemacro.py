@@ -1,5 +1,5 @@
 import os
-from lark import Lark, Tree, Token
+from lark import Lark, Tree, Token, Transformer
 from lark.exceptions import LarkError
 import unittest
 
@@ -35,67 +35,70 @@ WS: /[ \\t\\f\\r\\n]/+
 %ignore WS    
 """
 
-parser = Lark(GRAMMAR)
+class Kwarg:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+class MacroTransformer(Transformer):
+
+    def start(self, children):
+        ret_name = None
+        fn_name = None
+        pargs = []
+        kwargs = {}
+        for child in children:
+            if isinstance(child, Kwarg):
+                kwargs[child.name] = child.value
+            elif isinstance(child, Tree):
+                if child.data == 'ret_name':
+                    ret_name = child.children[0].value.strip()
+                else:
+                    fn_name = child.children[0].value.strip()
+            else:
+                pargs.append(child)
+        return ret_name, fn_name, pargs, kwargs
+
+    def name(self, children):
+        return children[0].value.strip()
+
+    def parg(self, children):
+        item = children[0]
+        if isinstance(item, Token):
+            return _unquote(item.value.strip())
+        return item
+
+    def list(self, children):
+        return children
+
+    def kwarg(self, children):
+        if len(children) > 1:
+            return Kwarg(children[0], children[1])
+        return Kwarg(children[0], True)
+
+parser = None
+
+def get_parser():
+    # lalr tables are pickled to temp dir by lark and reused by next runs
+    global parser
+    if parser is None:
+        parser = Lark(GRAMMAR, parser='lalr', transformer=MacroTransformer(), cache=True)
+    return parser
 
 def _unquote(s):
     if s.startswith('"') and s.endswith('"'):
         return s[1:-1]
     return s
 
-def find_data(tree, data, trace = False):
-    if trace:
-        print([child.data for child in tree.children])
-
-    return [child for child in tree.children if hasattr(child, 'data') and child.data == data]
-
-def find_tokens(tree, type):
-    return [child for child in tree.children if isinstance(child, Token) and child.type == type]
-
-def parse_kwarg(tree):
-    name = None
-    value = True
-    for item in find_data(tree, 'name'):
-        name = item.children[0].value.strip()
-    for item in find_data(tree, 'parg'):
-        value = parse_parg(item)
-    return name, value
-
-def parse_list(tree):
-    return [parse_parg(item) for item in find_data(tree, 'parg')]
-
-def parse_parg(tree):
-    for item in find_tokens(tree, 'ARG'):
-        return _unquote(item.value.strip())
-    for item in find_data(tree, 'list'):
-        return parse_list(item)
-
 class ParseMacroError(Exception):
     pass
 
 def parse_macro(s):
-
     try:
-        tree = parser.parse(s)
+        return get_parser().parse(s)
     except LarkError as e:
         raise ParseMacroError(e)
 
-    ret_name = None
-    fn_name = None
-
-    for item in find_data(tree, 'ret_name'):
-        ret_name = item.children[0].value.strip()
-    for item in find_data(tree, 'fn_name'):
-        fn_name = item.children[0].value.strip()
-
-    pargs = [parse_parg(item) for item in find_data(tree, 'parg')]
-    kwargs = {}
-
-    for item in find_data(tree, 'kwarg'):
-        k, v = parse_kwarg(item)
-        kwargs[k] = v
-
-    return ret_name, fn_name, pargs, kwargs
-
 class TestParse(unittest.TestCase):
 
     def test_ret(self):
@@ -130,5 +133,13 @@ class TestParse(unittest.TestCase):
         expected = None, "fn", ["()", ["foo","[]", "bar"]], {"baz": "[]"}
         self.assertEqual(parse_macro('fn("()", :baz = "[]", [foo , "[]" , bar])'), expected)
 
+    def test_nested_list(self):
+        expected = "res", "fn", [[], ["foo", ["bar"]]], {"baz": ["qux"], "quux": True}
+        self.assertEqual(parse_macro('res = fn([], [foo, [bar]], :baz=[qux], :quux)'), expected)
+
+    def test_error(self):
+        with self.assertRaises(ParseMacroError):
+            parse_macro('echo copy (x)')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,43 +1,20 @@
 import re
 import os
+import heapq
+from collections import defaultdict
 
 ON_PUSH = 1
 ON_TAG = 2
 ON_RELEASE = 3
 
-MACRO_NAMES = [
-    'pushd_cd', 'popd_cd', 
-    'find_app',
-    'download', 
-    'zip', 'unzip',
-    'set_path', 
-    'foreach',
-    'copy', 'xcopy', 'mkdir', 'rmdir', 'move', 'del',
-    'git_clone', 'git_pull', 'patch', 
-    'github_matrix', 'github_matrix_include', 'github_matrix_exclude', 
-    'github_checkout', 'github_upload', 'github_release', 'github_cache',
-    'github_setup_msys2', 'github_setup_node', 'github_setup_java',
-    'if_arg', 
-    'log', 
-    'where',
-    'set_var',
-    'substr', 
-    'use_tool', 'install_tool', 'call_vcvars',
-    'use', 'install', 'add_path',
-    'if_exist_return', 'clear_path',
-    'test_exist', 'return', 'assert'
-]
-
-DEPRECATED_MACRO_NAMES = [
-    'github_rmdir', 'rm', 'move_file', 'copy_file', 'copy_dir', 'untar', 'clean_dir', 'clean_file'
-]
-
 try:
     from .parsedef import parse_def, DEF_RX
     from .Opts import Opts
+    from .profiling import profiler
 except ImportError:
     from parsedef import parse_def, DEF_RX
     from Opts import Opts
+    from profiling import profiler
 
 def pat_spacejoin(*pat):
     SPACE = "\\s*"
@@ -45,7 +22,7 @@ def pat_spacejoin(*pat):
 
 def parse_statement(line, opts: Opts) -> bool:
 
-    m = re.match('^\\s*(env[_-]policy|use[_-]patch[_-]var|debug|clean|download[_-]test|unzip[_-]test|zip[_-]test|github|github[_-]workflow)\\s+(off|on|true|false|1|0)\\s*$', line)
+    m = re.match('^\\s*(env[_-]policy|use[_-]patch[_-]var|debug|clean|download[_-]test|unzip[_-]test|zip[_-]test|github|github[_-]workflow|github[_-]jobs|checkpoint|timing)\\s+(off|on|true|false|1|0)\\s*$', line)
     if m is not None:
         optname = m.group(1).replace("-","_")
         optval = m.group(2) in ['on','true','1']
@@ -96,6 +73,23 @@ def parse_statement(line, opts: Opts) -> bool:
         opts.curl_proxy = m.group(1).rstrip()
         return True
     
+    m = re.match('^\\s*parallel\\s+(on|off|[0-9]+)\\s*$', line)
+    if m is not None:
+        value = m.group(1)
+        opts.parallel = {'on': '%NUMBER_OF_PROCESSORS%', 'off': None}.get(value, value)
+        return True
+
+    m = re.match('^\\s*local[_-]matrix\\s+(on|off|[0-9]+)\\s*$', line)
+    if m is not None:
+        value = m.group(1)
+        opts.local_matrix = {'on': '%NUMBER_OF_PROCESSORS%', 'off': None}.get(value, value)
+        return True
+
+    m = re.match('^\\s*parallel[_-]downloads\\s+([0-9]+)\\s*$', line)
+    if m is not None:
+        opts.parallel_downloads = int(m.group(1))
+        return True
+
     m = re.search('^workflow[_-]name (.*)', line)
     if m:
         opts.workflow_name = m.group(1).strip()
@@ -108,18 +102,73 @@ def parse_order(line):
     if m:
         return [n.strip() for n in re.split('\\s+', m.group(1)) if n.strip() != ""]
 
-def update_chain(script, chain, tested):
-    name = next(filter(lambda n: n not in tested, chain), None)
-    if name is None:
-        return False
-    tested.add(name)
-    def get_deps(name):
-        return script.function(name)._deps
-    ins = [n for n in get_deps(name) if n not in chain]
-    ix = chain.index(name)
-    for i, n in enumerate(ins):
-        chain.insert(ix + i, n)
-    return True
+def schedule(roots, deps, after):
+    """
+    Topological order (Kahn's algorithm) of names reachable from roots,
+    deps[n] run before n, after[n] run after n.
+    Ties are broken by depth-first post-order rank so acyclic scripts keep their natural order:
+    deps in order of declaration, then function itself, then functions declared to run after it.
+    """
+    rank = dict()
+    # visit order, cycles are reported starting from first visited def
+    visited = dict()
+    stack = [(n, 'visit') for n in reversed(roots)]
+    while len(stack) > 0:
+        n, what = stack.pop()
+        if what == 'visit':
+            if n in visited:
+                continue
+            visited[n] = True
+            stack.append((n, 'after'))
+            stack.append((n, 'emit'))
+            stack.extend((d, 'visit') for d in reversed(deps.get(n, [])))
+        elif what == 'emit':
+            # post-order counter, ranks are unique so heap never compares names
+            rank[n] = len(rank)
+        else:
+            stack.extend((a, 'visit') for a in reversed(after.get(n, [])))
+
+    succ = defaultdict(list)
+    indegree = {n: 0 for n in visited}
+    for n in visited:
+        for d in deps.get(n, []):
+            succ[d].append(n)
+            indegree[n] += 1
+        for a in after.get(n, []):
+            succ[n].append(a)
+            indegree[a] += 1
+
+    heap = [(rank[n], n) for n, k in indegree.items() if k == 0]
+    heapq.heapify(heap)
+    res = []
+    while len(heap) > 0:
+        _, n = heapq.heappop(heap)
+        res.append(n)
+        for m in succ[n]:
+            indegree[m] -= 1
+            if indegree[m] == 0:
+                heapq.heappush(heap, (rank[m], m))
+
+    if len(res) < len(rank):
+        raise ValueError("cycle in def graph: {}".format(" -> ".join(find_cycle(indegree, succ))))
+    return res
+
+def find_cycle(indegree, succ):
+    # nodes left by Kahn's algorithm are on cycles or after them, walk back until node repeats,
+    # each def in path must run after the next one
+    pred = dict()
+    for n, ms in succ.items():
+        for m in ms:
+            if indegree[n] > 0 and indegree[m] > 0:
+                pred[m] = n
+    n = next(n for n, k in indegree.items() if k > 0)
+    path = []
+    seen = dict()
+    while n not in seen:
+        seen[n] = len(path)
+        path.append(n)
+        n = pred[n]
+    return path[seen[n]:] + [n]
 
 class Function:
     def __init__(self, name, then, deps, shell, condition):
@@ -129,10 +178,12 @@ class Function:
         self._shell = shell
         self._condition = condition
         self._body = []
-        self._macro_names = None
+        self._origins = []
+        self._macros = None
         
-    def append(self, line):
+    def append(self, line, origin=None):
         self._body.append(line)
+        self._origins.append(origin)
 
 class Script:
 
@@ -142,23 +193,26 @@ class Script:
         self._opts = Opts()
         self._function = None
         self._order = None
+        self._includes = []
 
     def function(self, name) -> Function:
         return self._functions[name]
 
-    def append(self, i, line):
+    def append(self, i, line, origin=None):
         # todo redefinitions
         if re.match('\\s*#', line):
             # print("# comments are deprecated, use :: or rem, line {}".format(i))
             return
 
-        if parse_statement(line, self._opts):
-            return
-        order = parse_order(line)
+        with profiler.phase('parse_statement'):
+            if parse_statement(line, self._opts):
+                return
+            order = parse_order(line)
         if order:
             self._order = order
             return
-        def_ = parse_def(line)
+        with profiler.phase('parse_def'):
+            def_ = parse_def(line)
         if def_ is not None:
             name, then, deps_, shell, condition = def_
             function = Function(name, then, deps_, shell, condition)
@@ -166,72 +220,149 @@ class Script:
             self._functions[name] = function
             return
         if self._function:
-            self._function.append(line)
+            self._function.append(line, origin)
         else:
             if line.strip() != '':
                 print("not used line: ", line)
 
-    def compute_order(self):
-        thens_ = dict()
+    def graph(self):
+        """
+        Returns roots, deps (name -> defs to run before) and after (name -> defs to run after)
+        """
+        deps = dict()
+        after = defaultdict(list)
+        for name, function in self._functions.items():
+            for dep in function._deps:
+                if dep not in self._functions:
+                    raise ValueError("{} depends on undefined {}".format(name, dep))
+            deps[name] = function._deps
+            if function._then is not None and function._then != 'exit':
+                if function._then not in self._functions:
+                    raise ValueError("{} then undefined {}".format(name, function._then))
+                after[name].append(function._then)
         if self._order is None:
-            main = self._function._name
-            chain = [main]
-            tested = set()
-            while update_chain(self, chain, tested):
-                pass
-            for a, b in zip(chain, chain[1:]):
-                thens_[a] = b
-            keys = chain
+            roots = [self._function._name]
         else:
-            raise ValueError("not implemented")
-        for i in range(1000):
-            changed = False
-            for a, b in thens_.items():
-                if a in keys:
-                    if b not in keys:
-                        keys.append(b)
-                        changed = True
-            if not changed:
-                break
+            for name in self._order:
+                if name not in self._functions:
+                    raise ValueError("order: undefined {}".format(name))
+            roots = self._order
+            for a, b in zip(self._order, self._order[1:]):
+                after[a].append(b)
+        return roots, deps, after
+
+    def predecessors(self, keys):
+        """
+        Returns name -> defs that must complete before it (depends on, then and order edges)
+        """
+        _, deps, after = self.graph()
+        res = {name: list(deps[name]) for name in keys}
+        for name in keys:
+            for b in after.get(name, []):
+                if name not in res[b]:
+                    res[b].append(name)
+        return res
+
+    def compute_order(self):
+        roots, deps, after = self.graph()
+        keys = schedule(roots, deps, after)
+        thens_ = dict()
+        for a, b in zip(keys, keys[1:]):
+            thens_[a] = b
+        for name in keys:
+            if self._functions[name]._then == 'exit':
+                thens_[name] = 'exit'
+        reachable = set(keys)
         for n in self._functions.keys():
-            if n not in keys:
+            if n not in reachable:
                 print("warning: not reachable {}".format(n))
         return keys, thens_
 
+file_cache = dict()
+
 def load_lines(path):
-    with open(path, encoding='utf-8') as f:
-        return list(f)
+    # process-wide cache, file is reread only if its mtime or size changed
+    st = os.stat(path)
+    key = st.st_mtime_ns, st.st_size
+    # absolute path, serve changes working directory between requests
+    abspath = os.path.abspath(path)
+    cached = file_cache.get(abspath)
+    if cached is None or cached[0] != key:
+        with open(path, encoding='utf-8') as f:
+            cached = key, tuple(f)
+        file_cache[abspath] = cached
+    return list(cached[1])
 
-def insert_includes(dirname, lines, included: set[str]):
-    res = []
-    changed = False
-    for line in lines:
-        m = re.match('\\s*include\\((.*)\\)', line)
-        if m:
-            name = m.group(1)
-            if os.path.splitext(name)[1] == '':
-                name = name + '.pbat'
-            p = os.path.join(dirname, name)
-            if p not in included:
+INCLUDE_RX = re.compile('\\s*include\\((.*)\\)')
+
+def include_path(dirname, name):
+    if os.path.splitext(name)[1] == '':
+        name = name + '.pbat'
+    return os.path.join(dirname, name), name
+
+def resolve_includes(src, dirname, lines, load=None):
+    """
+    Replaces include(path) lines with file contents, each file is included once.
+    File is inserted at its first include in breadth-first order (shallowest include wins),
+    include paths are relative to dirname of main script.
+    load(path) returns text or lines of included file or None if it does not exist, files are read from disk by default.
+    Returns lines, origins (path, lineno) of lines and set of included files.
+    """
+    included = {src}
+    contents = {src: lines}
+    claims = dict()
+    queue = [src]
+    for path in queue:
+        for i, line in enumerate(contents[path]):
+            m = INCLUDE_RX.match(line)
+            if m is None:
+                continue
+            p, name = include_path(dirname, m.group(1))
+            if p in included:
+                claims[(path, i)] = None
+                continue
+            if load is None:
                 if not os.path.exists(p):
                     raise ValueError("{} ({}) not exist".format(p, name))
-                res.extend(load_lines(p))
-                included.add(p)
-                changed = True
-        else:
-            res.append(line)
-    return res, changed
+                lines_ = load_lines(p)
+            else:
+                lines_ = load(p)
+                if lines_ is None:
+                    raise ValueError("{} ({}) not exist".format(p, name))
+                if isinstance(lines_, str):
+                    lines_ = lines_.splitlines(True)
+            included.add(p)
+            contents[p] = lines_
+            claims[(path, i)] = p
+            queue.append(p)
 
-def parse_script(src, github) -> Script:
-    # todo includes
+    res = []
+    origins = []
+    stack = [(src, 0)]
+    while len(stack) > 0:
+        path, i = stack.pop()
+        lines_ = contents[path]
+        while i < len(lines_):
+            if (path, i) in claims:
+                p = claims[(path, i)]
+                if p is not None:
+                    stack.append((path, i + 1))
+                    stack.append((p, 0))
+                    break
+            else:
+                res.append(lines_[i])
+                origins.append((path, i + 1))
+            i += 1
+    return res, origins, included
+
+def parse_script(src, github=False, text=None, load=None) -> Script:
+    """
+    Parses file src or text (src is used as name then), see resolve_includes() for load
+    """
     dirname = os.path.dirname(src)
-    lines = load_lines(src)
-    included = set()
-    included.add(src)
-    while True:
-        lines, changed = insert_includes(dirname, lines, included)
-        if not changed:
-            break
+    with profiler.phase('include'):
+        lines = load_lines(src) if text is None else text.splitlines(True)
+        lines, origins, included = resolve_includes(src, dirname, lines, load)
 
     if len(lines) > 0:
         lines[-1] = lines[-1] + "\n"
@@ -244,9 +375,84 @@ def parse_script(src, github) -> Script:
 
     if not has_def:
         lines = ['def main\n'] + lines
+        origins = [None] + origins
 
     script = Script()
-    for i, line in enumerate(lines):
-        script.append(i, line)
+    profiler.count('script_lines', len(lines))
+    with profiler.phase('parse_script'):
+        for i, line in enumerate(lines):
+            script.append(i, line, origins[i])
     script._opts.github = github
+    script._includes = sorted(included - {src})
     return script
+
+import unittest
+
+class TestIncludes(unittest.TestCase):
+    def test_order(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            files = {
+                'main': 'include(a)\necho main\ninclude(b)\n',
+                'a': 'include(c)\necho a\n',
+                'b': 'include(c)\ninclude(main)\necho b\n',
+                'c': 'echo c\n'
+            }
+            for name, text in files.items():
+                with open(os.path.join(d, name + '.pbat'), 'w') as f:
+                    f.write(text)
+            src = os.path.join(d, 'main.pbat')
+            lines, origins, included = resolve_includes(src, d, load_lines(src))
+            self.assertEqual(['echo c\n', 'echo a\n', 'echo main\n', 'echo b\n'], lines)
+            self.assertEqual([('c', 1), ('a', 2), ('main', 2), ('b', 3)], [(os.path.basename(p)[:-5], i) for p, i in origins])
+            self.assertEqual(4, len(included))
+
+class TestSchedule(unittest.TestCase):
+    def test_deps(self):
+        deps = {'main': ['a', 'b'], 'a': ['c'], 'b': ['c']}
+        self.assertEqual(['c', 'a', 'b', 'main'], schedule(['main'], deps, {}))
+    def test_dep_declared_later(self):
+        deps = {'main': ['a', 'b'], 'a': ['b']}
+        self.assertEqual(['b', 'a', 'main'], schedule(['main'], deps, {}))
+    def test_then(self):
+        deps = {'b': ['c']}
+        after = {'a': ['b']}
+        self.assertEqual(['a', 'c', 'b'], schedule(['a'], deps, after))
+    def test_then_and_depends_cycle(self):
+        deps = {'b': ['a']}
+        after = {'b': ['a']}
+        with self.assertRaises(ValueError) as e:
+            schedule(['b'], deps, after)
+        self.assertEqual('cycle in def graph: b -> a -> b', str(e.exception))
+    def test_predecessors(self):
+        script = Script()
+        for i, line in enumerate(['def a then c\n', 'def b\n', 'def c depends on b\n', 'def main depends on a and c\n']):
+            script.append(i, line)
+        keys, _ = script.compute_order()
+        self.assertEqual(['a', 'b', 'c', 'main'], keys)
+        self.assertEqual({'a': [], 'b': [], 'c': ['b', 'a'], 'main': ['a', 'c']}, script.predecessors(keys))
+    def test_then_position(self):
+        # function declared to run after dep runs right after it, name does not matter
+        for report in ['areport', 'zreport']:
+            self.assertEqual(['build', 'test', report, 'main'], schedule(['main'], {'main': ['build', 'test']}, {'test': [report]}))
+    def test_order_statement(self):
+        script = Script()
+        for i, line in enumerate(['def setup\n', 'def build depends on setup\n', 'def test then report\n', 'def report\n', 'def main\n', 'order build test main\n']):
+            script.append(i, line)
+        keys, thens = script.compute_order()
+        self.assertEqual(['setup', 'build', 'test', 'report', 'main'], keys)
+        self.assertEqual({'setup': 'build', 'build': 'test', 'test': 'report', 'report': 'main'}, thens)
+    def test_order_undefined(self):
+        script = Script()
+        for i, line in enumerate(['def main\n', 'order main other\n']):
+            script.append(i, line)
+        with self.assertRaises(ValueError):
+            script.compute_order()
+    def test_cycle(self):
+        deps = {'main': ['a'], 'a': ['b'], 'b': ['c'], 'c': ['a']}
+        with self.assertRaises(ValueError) as e:
+            schedule(['main'], deps, {})
+        self.assertEqual('cycle in def graph: a -> b -> c -> a', str(e.exception))
+
+if __name__ == '__main__':
+    unittest.main()
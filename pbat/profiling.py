@@ -0,0 +1,160 @@
+import time
+import json
+from collections import defaultdict
+
+class NullPhase:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+NULL_PHASE = NullPhase()
+
+class Phase:
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._profiler._stack.append([self._name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *args):
+        name, start, children = self._profiler._stack.pop()
+        elapsed = time.perf_counter() - start
+        stats = self._profiler._current()
+        # self time, nested phases are not counted twice
+        phase = stats["phases"][name]
+        phase[0] += elapsed - children
+        phase[1] += 1
+        if len(self._profiler._stack) > 0:
+            self._profiler._stack[-1][2] += elapsed
+        return False
+
+class FileScope:
+
+    def __init__(self, profiler, src):
+        self._profiler = profiler
+        self._src = src
+
+    def __enter__(self):
+        self._prev = self._profiler._file
+        self._profiler._file = self._src
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._profiler._current()["seconds"] += time.perf_counter() - self._start
+        self._profiler._file = self._prev
+        return False
+
+def new_stats():
+    return {"seconds": 0.0, "phases": defaultdict(lambda: [0.0, 0]), "counters": defaultdict(int)}
+
+class Profiler:
+    """
+    Per-file compiler phase timing (self time and calls) and counters.
+    Disabled by default, phase() returns shared no-op context then.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._file = None
+        self._stack = []
+        self._files = dict()
+
+    def _current(self):
+        stats = self._files.get(self._file)
+        if stats is None:
+            stats = new_stats()
+            self._files[self._file] = stats
+        return stats
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, name)
+
+    def file(self, src):
+        if not self.enabled:
+            return NULL_PHASE
+        return FileScope(self, src)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self._current()["counters"][name] += n
+
+    def totals(self):
+        res = new_stats()
+        for stats in self._files.values():
+            res["seconds"] += stats["seconds"]
+            for name, (seconds, calls) in stats["phases"].items():
+                res["phases"][name][0] += seconds
+                res["phases"][name][1] += calls
+            for name, n in stats["counters"].items():
+                res["counters"][name] += n
+        return res
+
+    def to_json(self):
+        def convert(stats):
+            return {
+                "seconds": round(stats["seconds"], 6),
+                "phases": {name: {"seconds": round(seconds, 6), "calls": calls} for name, (seconds, calls) in stats["phases"].items()},
+                "counters": dict(stats["counters"])
+            }
+        files = {src: convert(stats) for src, stats in self._files.items() if src is not None}
+        return {"total": convert(self.totals()), "files": files}
+
+    def report(self, top=10):
+        totals = self.totals()
+        phases = sorted(totals["phases"].items(), key=lambda item: -item[1][0])
+        measured = sum(seconds for seconds, _ in totals["phases"].values())
+        if totals["seconds"] > measured:
+            # compiler code outside of instrumented phases
+            phases.append(("other", (totals["seconds"] - measured, 0)))
+        total = max(measured, totals["seconds"])
+        lines = ["{:<20} {:>10} {:>10} {:>6}".format("phase", "calls", "seconds", "%")]
+        for name, (seconds, calls) in phases:
+            percent = 100.0 * seconds / total if total > 0 else 0.0
+            lines.append("{:<20} {:>10} {:>10.4f} {:>6.1f}".format(name, calls, seconds, percent))
+        if len(totals["counters"]) > 0:
+            lines.append("")
+            lines.append("{:<20} {:>10}".format("counter", "value"))
+            for name, n in sorted(totals["counters"].items()):
+                lines.append("{:<20} {:>10}".format(name, n))
+        files = sorted([(src, stats) for src, stats in self._files.items() if src is not None], key=lambda item: -item[1]["seconds"])
+        if len(files) > 0:
+            lines.append("")
+            lines.append("{:<50} {:>10}".format("file (slowest {})".format(min(top, len(files))), "seconds"))
+            for src, stats in files[:top]:
+                lines.append("{:<50} {:>10.4f}".format(src, stats["seconds"]))
+        return "\n".join(lines)
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=1)
+
+profiler = Profiler()
+
+import unittest
+
+class TestProfiler(unittest.TestCase):
+    def test_self_time(self):
+        profiler = Profiler()
+        with profiler.phase('a'):
+            pass
+        profiler.enabled = True
+        with profiler.file('x.pbat'):
+            with profiler.phase('a'):
+                with profiler.phase('b'):
+                    time.sleep(0.01)
+                profiler.count('n', 2)
+        stats = profiler.to_json()["files"]["x.pbat"]
+        self.assertEqual(1, stats["phases"]["a"]["calls"])
+        self.assertLess(stats["phases"]["a"]["seconds"], stats["phases"]["b"]["seconds"])
+        self.assertEqual({'n': 2}, stats["counters"])
+        self.assertGreaterEqual(stats["seconds"], stats["phases"]["b"]["seconds"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import re
+from dataclasses import dataclass
+
+CALLEE_RX = re.compile('^\\s*(?:[a-z0-9_-]+\\s*=\\s*)?([a-z0-9_-]+)\\s*\\(', re.IGNORECASE)
+
+def validate_args(fnname, args, kwargs, ret, argmin = None, argmax = None, kwnames = None, needret = False):
+
+    argmin_ = argmin is not None and argmin > -1
+    argmax_ = argmax is not None and argmax > -1
+
+    if argmin_ and argmax_:
+        if not (argmin <= len(args) <= argmax):
+            if argmin == argmax:
+                nargs = str(argmin)
+            else:
+                nargs = "{} to {}".format(argmin, argmax)
+            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
+    elif argmin_:
+        if len(args) < argmin:
+            nargs = "{} or more".format(argmin)
+            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
+    elif argmax_:
+        if len(args) > argmax:
+            nargs = "{} or less".format(argmin)
+            raise Exception("{} expects {} args, got {}: {}".format(fnname, nargs, len(args), str(args)))
+
+    if kwnames is not None:
+        for n in kwargs:
+            if n not in kwnames:
+                raise Exception("{} unknown option {}".format(fnname, n))
+    if needret and ret is None:
+        raise Exception("{} must be assigned to env variable".format(fnname))
+
+@dataclass
+class Signature:
+    argmin: int = None
+    argmax: int = None
+    kwnames: set = None
+    needret: bool = False
+
+    def validate(self, fnname, args, kwargs, ret):
+        validate_args(fnname, args, kwargs, ret, self.argmin, self.argmax, self.kwnames, self.needret)
+
+@dataclass
+class Macro:
+    name: str
+    fn: object = None
+    signature: Signature = None
+    deprecated: bool = False
+
+class Registry:
+
+    def __init__(self):
+        self._macros = dict()
+
+    def register(self, name, fn, argmin = None, argmax = None, kwnames = None, needret = False, validate = True):
+        """
+        fn(name, args, kwargs, ret, opts, ctx, githubdata) returns text that replaces macro line,
+        args are checked against signature before call unless validate is False,
+        parsed args and kwargs are cached and shared between calls, fn must not modify them
+        """
+        signature = Signature(argmin, argmax, kwnames, needret) if validate else None
+        self._macros[name] = Macro(name, fn, signature)
+        return fn
+
+    def deprecate(self, *names):
+        for name in names:
+            self._macros[name] = Macro(name, deprecated=True)
+
+    def macro(self, name, argmin = None, argmax = None, kwnames = None, needret = False, validate = True):
+        def decorator(fn):
+            return self.register(name, fn, argmin, argmax, kwnames, needret, validate)
+        return decorator
+
+    def get(self, name) -> Macro:
+        return self._macros.get(name)
+
+    def names(self):
+        return [name for name, macro in self._macros.items() if not macro.deprecated]
+
+    def maybe_macro(self, line):
+        if ')' not in line:
+            return False
+        m = CALLEE_RX.match(line)
+        return m is not None and m.group(1) in self._macros
+
+    def call(self, macroname, name, args, kwargs, ret, opts, ctx, githubdata):
+        macro = self._macros[macroname]
+        if macro.signature is not None:
+            macro.signature.validate(macroname, args, kwargs, ret)
+        return macro.fn(name, args, kwargs, ret, opts, ctx, githubdata)
+
+registry = Registry()
+
+def register_macro(name, fn, argmin = None, argmax = None, kwnames = None, needret = False, validate = True):
+    """
+    Registers third-party macro, must be called before scripts are compiled
+    """
+    return registry.register(name, fn, argmin, argmax, kwnames, needret, validate)
+
+def macro(name, argmin = None, argmax = None, kwnames = None, needret = False, validate = True):
+    return registry.macro(name, argmin, argmax, kwnames, needret, validate)
+
+import unittest
+
+class TestRegistry(unittest.TestCase):
+    def test_maybe_macro(self):
+        registry = Registry()
+        registry.register('copy', None)
+        registry.deprecate('copy_file')
+        self.assertTrue(registry.maybe_macro('    copy(a, b)\n'))
+        self.assertTrue(registry.maybe_macro('X = copy (a, b)'))
+        self.assertTrue(registry.maybe_macro('copy_file(a, b)'))
+        self.assertFalse(registry.maybe_macro('echo copy (x)'))
+        self.assertFalse(registry.maybe_macro('xcopy(a, b)'))
+        self.assertFalse(registry.maybe_macro('copy(a, b'))
+
+    def test_call(self):
+        registry = Registry()
+        @registry.macro('twice', 1, 1, {'n'}, True)
+        def macro_twice(name, args, kwargs, ret, opts, ctx, githubdata):
+            return 'set {}={}{}'.format(ret, args[0], args[0])
+        self.assertEqual('set X=aa', registry.call('twice', 'main', ['a'], {}, 'X', None, None, None))
+        with self.assertRaises(Exception):
+            registry.call('twice', 'main', ['a', 'b'], {}, 'X', None, None, None)
+        with self.assertRaises(Exception):
+            registry.call('twice', 'main', ['a'], {'m': None}, 'X', None, None, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+
+def default_socket():
+    dirname = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    if hasattr(os, 'getuid'):
+        return os.path.join(dirname, 'pbat-{}.sock'.format(os.getuid()))
+    return os.path.join(dirname, 'pbat.sock')
+
+def check_unix_sockets():
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError("unix sockets are not available on this platform")
+
+def read_message(conn):
+    data = bytearray()
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(64 * 1024)
+        if not chunk:
+            break
+        data += chunk
+    if len(data) == 0:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+def write_message(conn, message):
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+def send(path, message, timeout=None):
+    """
+    Sends message to server and returns response, None if server is not running
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    with conn:
+        conn.settimeout(timeout)
+        write_message(conn, message)
+        return read_message(conn)
+
+# hung server must not block client, it compiles by itself instead
+COMPILE_TIMEOUT = 60
+
+def request_compile(paths, force, path=None, timeout=COMPILE_TIMEOUT):
+    """
+    Forwards compilation to server and prints its output, returns False if server is not running
+    or did not respond in time
+    """
+    try:
+        response = send(path or default_socket(), {"op": "compile", "cwd": os.getcwd(), "paths": paths, "force": force}, timeout=timeout)
+    except OSError as e:
+        print("server did not respond ({}), compiling locally".format(e))
+        return False
+    if response is None:
+        return False
+    print(response["output"], end='')
+    return True
+
+def handle(message):
+    """
+    Compiles in working directory of client, parsers, file contents, parsed macros and source hashes
+    stay cached in this process between requests (files are reread and rehashed when mtime changes)
+    """
+    try:
+        from .compile import compile_sources
+    except ImportError:
+        from compile import compile_sources
+    import io
+    import contextlib
+    output = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(output):
+            os.chdir(message["cwd"])
+            compile_sources(message["paths"], message.get("force", False), 1)
+    except Exception as e:
+        output.write("{}\n".format(e))
+    finally:
+        os.chdir(cwd)
+    return {"output": output.getvalue()}
+
+# client that connects and sends nothing must not block server
+TIMEOUT = 10
+
+def serve(path, timeout=TIMEOUT, ready=None):
+    check_unix_sockets()
+    if os.path.exists(path):
+        if send(path, {"op": "ping"}, timeout=1) is not None:
+            raise OSError("server is already running on {}".format(path))
+        # left by killed server
+        os.unlink(path)
+    # parsers are built before first request
+    try:
+        from .parsemacro import get_parser
+        from . import core
+    except ImportError:
+        from parsemacro import get_parser
+        import core
+    get_parser()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    print("serving on {}, press Ctrl+C to stop".format(path))
+    if ready is not None:
+        ready()
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                conn.settimeout(timeout)
+                try:
+                    message = read_message(conn)
+                    if message is None:
+                        continue
+                    op = message.get("op")
+                    if op == "compile":
+                        write_message(conn, handle(message))
+                    elif op == "ping":
+                        write_message(conn, {"output": ""})
+                    elif op == "stop":
+                        write_message(conn, {"output": "stopped\n"})
+                        break
+                except (OSError, ValueError) as e:
+                    print("bad request: {}".format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='pbat serve', description='keeps warm compiler process, use `pbat -s` to compile with it')
+    parser.add_argument("--socket", help='socket path, default {}'.format(default_socket()))
+    parser.add_argument("--stop", action='store_true', help='stop running server')
+    args = parser.parse_args(argv)
+    path = args.socket or default_socket()
+    if args.stop:
+        response = send(path, {"op": "stop"})
+        print("server is not running" if response is None else response["output"], end='' if response else '\n')
+        return
+    try:
+        serve(path)
+    except OSError as e:
+        print(e)
+        sys.exit(1)
+
+import unittest
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "unix sockets are not available")
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        import threading
+        import contextlib
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+        self.path = os.path.join(self.dir, 'pbat.sock')
+        started = threading.Event()
+        def run():
+            with contextlib.redirect_stdout(None):
+                serve(self.path, 0.2, started.set)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self.assertTrue(started.wait(10))
+
+    def tearDown(self):
+        send(self.path, {"op": "stop"}, timeout=10)
+        self.thread.join(10)
+        self._tmp.cleanup()
+
+    def test_compile(self):
+        src = os.path.join(self.dir, 'a.pbat')
+        with open(src, 'w', encoding='utf-8') as f:
+            f.write('def main\n    echo main\n')
+        response = send(self.path, {"op": "compile", "cwd": self.dir, "paths": ['a.pbat'], "force": True}, timeout=30)
+        self.assertIn("1 compiled, 0 failed, 0 skipped", response["output"])
+        with open(os.path.join(self.dir, 'a.bat'), encoding='cp866') as f:
+            self.assertIn('echo main', f.read())
+        response = send(self.path, {"op": "compile", "cwd": self.dir, "paths": ['a.pbat'], "force": False}, timeout=30)
+        self.assertIn("0 compiled, 0 failed, 1 skipped", response["output"])
+
+    def test_failed(self):
+        with open(os.path.join(self.dir, 'a.pbat'), 'w', encoding='utf-8') as f:
+            f.write('def main\n    echo main\n')
+        with open(os.path.join(self.dir, 'b.pbat'), 'w', encoding='utf-8') as f:
+            f.write('def main depends on missing\n    echo main\n')
+        response = send(self.path, {"op": "compile", "cwd": self.dir, "paths": ['a.pbat', 'b.pbat'], "force": True}, timeout=30)
+        self.assertIn("1 compiled, 1 failed, 0 skipped", response["output"])
+
+    def test_idle_client(self):
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(self.path)
+        try:
+            self.assertEqual({"output": ""}, send(self.path, {"op": "ping"}, timeout=10))
+        finally:
+            idle.close()
+
+    def test_not_running(self):
+        self.assertIsNone(send(os.path.join(self.dir, 'other.sock'), {"op": "ping"}))
+
+    def test_hung_server(self):
+        import io
+        import contextlib
+        path = os.path.join(self.dir, 'hung.sock')
+        hung = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        hung.bind(path)
+        # accepts connection but never responds
+        hung.listen(1)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertFalse(request_compile(['a.pbat'], False, path, timeout=0.2))
+            self.assertIn("compiling locally", output.getvalue())
+        finally:
+            hung.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+import os
+import sys
+import time
+import struct
+from collections import defaultdict
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class Graph:
+    """
+    Reverse include graph: for every file the set of sources that include it.
+    Include lists from parse_script are already transitive.
+    """
+
+    def __init__(self):
+        self._includes = dict()
+        self._included_by = defaultdict(set)
+
+    def set(self, src, includes):
+        self.remove(src)
+        key = os.path.abspath(src)
+        self._includes[key] = (src, [os.path.abspath(path) for path in includes])
+        for path in self._includes[key][1]:
+            self._included_by[path].add(key)
+
+    def remove(self, src):
+        key = os.path.abspath(src)
+        if key not in self._includes:
+            return
+        for path in self._includes[key][1]:
+            self._included_by[path].discard(key)
+        del self._includes[key]
+
+    def sources(self):
+        return [src for src, _ in self._includes.values()]
+
+    def files(self):
+        res = set(self._includes.keys())
+        for _, includes in self._includes.values():
+            res.update(includes)
+        return res
+
+    def affected(self, path):
+        path = os.path.abspath(path)
+        keys = set(self._included_by.get(path, set()))
+        if path in self._includes:
+            keys.add(path)
+        return [self._includes[key][0] for key in keys]
+
+class PollingWatcher:
+
+    def __init__(self, interval=0.5):
+        self._interval = interval
+        self._mtimes = dict()
+        self._listings = dict()
+
+    def _stat(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _listing(self, dirname):
+        # new subdirectories are reported too, sources can appear there
+        try:
+            with os.scandir(dirname) as it:
+                return frozenset(e.name for e in it if e.name.endswith('.pbat') or e.is_dir())
+        except OSError:
+            return frozenset()
+
+    def update(self, files, dirs=()):
+        self._mtimes = {path: self._stat(path) for path in files}
+        dirs = set(os.path.dirname(path) for path in files) | set(os.path.abspath(dirname) for dirname in dirs)
+        # known listings are kept, changes made since last call are reported by next one
+        self._listings = {dirname: self._listings[dirname] if dirname in self._listings else self._listing(dirname) for dirname in dirs}
+
+    def changes(self, timeout):
+        start = time.monotonic()
+        while True:
+            changed = set()
+            for path, mtime in self._mtimes.items():
+                mtime_ = self._stat(path)
+                if mtime_ != mtime:
+                    self._mtimes[path] = mtime_
+                    changed.add(path)
+            for dirname, listing in self._listings.items():
+                listing_ = self._listing(dirname)
+                if listing_ != listing:
+                    self._listings[dirname] = listing_
+                    changed.update(os.path.join(dirname, n) for n in listing_.symmetric_difference(listing))
+            if len(changed) > 0:
+                return changed
+            if timeout is not None and time.monotonic() - start >= timeout:
+                return changed
+            time.sleep(self._interval)
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """
+    Watches directories of files (editors often save by replacing file) and directories where sources can appear
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        fd = libc.inotify_init1(IN_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._libc = libc
+        self._fd = fd
+        self._dirs = dict()
+
+    def update(self, files, dirs=()):
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        watched = set(self._dirs.values())
+        dirs = set(os.path.dirname(path) for path in files) | set(os.path.abspath(dirname) for dirname in dirs)
+        for dirname in dirs:
+            if dirname in watched or not os.path.isdir(dirname):
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirname), mask)
+            if wd >= 0:
+                self._dirs[wd] = dirname
+
+    def changes(self, timeout):
+        import select
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        changed = set()
+        if not readable:
+            return changed
+        data = os.read(self._fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + size].rstrip(b'\0')
+            pos += size
+            if mask & IN_IGNORED:
+                # directory was removed, watch is removed by kernel
+                self._dirs.pop(wd, None)
+            elif wd in self._dirs and name:
+                changed.add(os.path.join(self._dirs[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+def make_watcher():
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except OSError:
+            pass
+    return PollingWatcher()
+
+def wait_changes(watcher, debounce):
+    changed = watcher.changes(None)
+    # burst of saves is compiled once
+    while True:
+        more = watcher.changes(debounce)
+        if len(more) == 0:
+            return changed
+        changed.update(more)
+
+def watch(includes, discover, recompile, dirs=None, debounce=0.2):
+    """
+    includes: source -> list of included files
+    discover: returns current list of sources
+    recompile: compiles list of sources and returns source -> CompileResult (None on error)
+    dirs: returns current list of directories where sources are discovered
+    """
+    if dirs is None:
+        dirs = lambda: []
+    graph = Graph()
+    failed = set()
+    for src, includes_ in includes.items():
+        graph.set(src, includes_)
+
+    watcher = make_watcher()
+    watcher.update(graph.files(), dirs())
+    print("watching {} files, press Ctrl+C to stop".format(len(graph.files())))
+
+    try:
+        while True:
+            changed = wait_changes(watcher, debounce)
+            todo = set(failed)
+            for path in changed:
+                todo.update(graph.affected(path))
+            sources = discover()
+            known = set(os.path.abspath(src) for src in graph.sources())
+            for src in sources:
+                if os.path.abspath(src) not in known:
+                    todo.add(src)
+            current = set(os.path.abspath(src) for src in sources)
+            for src in graph.sources():
+                if os.path.abspath(src) not in current:
+                    graph.remove(src)
+                    todo.discard(src)
+            todo = [src for src in sources if src in todo]
+            if len(todo) > 0:
+                results = recompile(todo)
+                failed = set()
+                for src in todo:
+                    result = results.get(src)
+                    if result is None:
+                        failed.add(src)
+                        if os.path.abspath(src) not in known:
+                            graph.set(src, [])
+                    else:
+                        graph.set(src, result.includes)
+            # new directories are watched even if they have no sources yet
+            watcher.update(graph.files(), dirs())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+import unittest
+
+class TestGraph(unittest.TestCase):
+    def test_affected(self):
+        graph = Graph()
+        graph.set('a.pbat', ['common.pbat', 'lib.pbat'])
+        graph.set('b.pbat', ['lib.pbat'])
+        self.assertEqual(['a.pbat'], graph.affected('common.pbat'))
+        self.assertEqual(['a.pbat', 'b.pbat'], sorted(graph.affected('lib.pbat')))
+        self.assertEqual(['b.pbat'], graph.affected(os.path.abspath('b.pbat')))
+        self.assertEqual([], graph.affected('other.pbat'))
+
+    def test_includes_changed(self):
+        graph = Graph()
+        graph.set('a.pbat', ['common.pbat'])
+        graph.set('a.pbat', ['lib.pbat'])
+        self.assertEqual([], graph.affected('common.pbat'))
+        self.assertEqual(['a.pbat'], graph.affected('lib.pbat'))
+        self.assertEqual(set(os.path.abspath(path) for path in ['a.pbat', 'lib.pbat']), graph.files())
+
+    def test_remove(self):
+        graph = Graph()
+        graph.set('a.pbat', ['common.pbat'])
+        graph.set('b.pbat', ['common.pbat'])
+        graph.remove('a.pbat')
+        graph.remove('missing.pbat')
+        self.assertEqual(['b.pbat'], graph.affected('common.pbat'))
+        self.assertEqual(['b.pbat'], graph.sources())
+
+class ListWatcher:
+    def __init__(self, batches):
+        self._batches = list(batches)
+        self.timeouts = []
+        self.dirs = []
+        self.closed = False
+
+    def update(self, files, dirs=()):
+        self.dirs.append(list(dirs))
+
+    def changes(self, timeout):
+        self.timeouts.append(timeout)
+        return set(self._batches.pop(0)) if len(self._batches) > 0 else set()
+
+    def close(self):
+        self.closed = True
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_debounce(self):
+        watcher = ListWatcher([['a'], ['b'], ['a', 'c']])
+        self.assertEqual({'a', 'b', 'c'}, wait_changes(watcher, 0.1))
+        self.assertEqual([None, 0.1, 0.1, 0.1], watcher.timeouts)
+
+    def test_watch_closes_watcher(self):
+        import contextlib
+        from unittest import mock
+        watcher = ListWatcher([['a.pbat']])
+        def recompile(todo):
+            self.assertEqual(['a.pbat'], todo)
+            raise KeyboardInterrupt()
+        with mock.patch.dict(globals(), make_watcher=lambda: watcher), contextlib.redirect_stdout(None):
+            watch({}, lambda: ['a.pbat'], recompile, lambda: ['src'])
+        self.assertEqual([['src']], watcher.dirs)
+        self.assertTrue(watcher.closed)
+
+    def test_polling_new_file(self):
+        src = self.write('a.pbat', 'def main\n')
+        watcher = PollingWatcher(0.01)
+        watcher.update([src])
+        self.assertEqual(set(), watcher.changes(0))
+        path = self.write('b.pbat', 'def main\n')
+        self.write('b.bat', '')
+        self.assertEqual({path}, watcher.changes(5))
+
+    def test_polling_modified(self):
+        src = self.write('a.pbat', 'def main\n')
+        watcher = PollingWatcher(0.01)
+        watcher.update([src])
+        st = os.stat(src)
+        os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertEqual({src}, watcher.changes(5))
+        self.assertEqual(set(), watcher.changes(0))
+
+    def test_polling_new_dir(self):
+        watcher = PollingWatcher(0.01)
+        watcher.update([], [self.dir])
+        sub = os.path.join(self.dir, 'sub')
+        os.mkdir(sub)
+        self.assertEqual({sub}, watcher.changes(5))
+        watcher.update([], [self.dir, sub])
+        path = self.write('sub/b.pbat', 'def main\n')
+        self.assertEqual({path}, watcher.changes(5))
+
+    def test_polling_deleted(self):
+        src = self.write('a.pbat', 'def main\n')
+        watcher = PollingWatcher(0.01)
+        watcher.update([src])
+        os.unlink(src)
+        self.assertEqual({src}, watcher.changes(5))
+
+    def inotify_changes(self, watcher, path):
+        changed = set()
+        deadline = time.monotonic() + 5
+        while path not in changed and time.monotonic() < deadline:
+            changed.update(watcher.changes(1))
+        return changed
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_new_file(self):
+        src = self.write('a.pbat', 'def main\n')
+        watcher = InotifyWatcher()
+        try:
+            watcher.update([src])
+            path = self.write('b.pbat', 'def main\n')
+            self.assertIn(path, self.inotify_changes(watcher, path))
+        finally:
+            watcher.close()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "inotify is linux only")
+    def test_inotify_new_dir(self):
+        watcher = InotifyWatcher()
+        try:
+            watcher.update([], [self.dir])
+            sub = os.path.join(self.dir, 'sub')
+            os.mkdir(sub)
+            self.assertIn(sub, self.inotify_changes(watcher, sub))
+            watcher.update([], [self.dir, sub])
+            path = self.write('sub/b.pbat', 'def main\n')
+            self.assertIn(path, self.inotify_changes(watcher, path))
+        finally:
+            watcher.close()
+        # second close is no-op
+        watcher.close()
+
+if __name__ == "__main__":
+    unittest.main()
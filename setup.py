@@ -1,12 +1,16 @@
 from setuptools import setup, find_packages
+import re
 
 with open('readme.md', encoding='utf-8') as f:
     long_description = f.read()
 
+with open('pbat/__init__.py', encoding='utf-8') as f:
+    version = re.search("__version__ = '(.*)'", f.read()).group(1)
+
 setup(
     packages = find_packages(),
     name = 'pbat',
-    version = '0.0.26',
+    version = version,
     author = "Stanislav Doronin",
     author_email = "mugisbrows@gmail.com",
     url = 'https://github.com/mugiseyebrows/pbat',